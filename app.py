@@ -1,46 +1,148 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, g, has_request_context, get_template_attribute, send_from_directory, request_finished
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 import os
 import csv
 from io import StringIO
 from werkzeug.utils import secure_filename
+import numpy as np
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 import logging
 import sys
 import time
 import json
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import traceback
+import threading
+import queue
+import random
+import uuid
+import atexit
+import hashlib
+import signal
+import socket
+import sqlite3
+import hmac
+import base64
+import itertools
+import re
+import gzip
+import mimetypes
+import urllib.request
+import urllib.parse
+import urllib.error
+import math
+import multiprocessing
+import heapq
+from functools import wraps
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+from sqlalchemy import event, inspect, create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+import click
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Without Pillow bikes are served from their original upload
+    Image = ImageOps = None
+try:
+    import brotli
+except ImportError:  # Static assets then only get gzip siblings
+    brotli = None
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # /metrics then answers 503; request logs still carry query stats
+    prometheus_client = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Add file handler for logging
+# Request logging settings
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+REQUEST_LOG_SAMPLE_RATE = float(os.getenv('REQUEST_LOG_SAMPLE_RATE', '1.0'))
+REQUEST_LOG_SLOW_MS = float(os.getenv('REQUEST_LOG_SLOW_MS', '1000'))
+REQUEST_LOG_BODIES = os.getenv('REQUEST_LOG_BODIES', 'false').lower() == 'true'
+QUERY_PROFILE_SLOWEST = int(os.getenv('QUERY_PROFILE_SLOWEST', '3'))
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', '10'))
+LOGGED_STATEMENT_LENGTH = 500
+REDACTED_FIELDS = {'password', 'password_hash', 'license', 'license_number', 'phone', 'email', 'csrf_token'}
+
+class JsonLineFormatter(logging.Formatter):
+    # Runs on the writer thread, so serialization stays off the request path
+    def format(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields is None:
+            fields = {'level': record.levelname, 'message': record.getMessage()}
+        return json.dumps(fields, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    # Never block or raise in the request thread: drop records when the
+    # writer falls behind and count them instead
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Skip QueueHandler's eager formatting; the writer formats
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# File handlers run on a background listener thread fed through a queue
 if not os.path.exists('logs'):
     os.makedirs('logs')
-file_handler = RotatingFileHandler('logs/app.log', maxBytes=10240, backupCount=10)
+file_handler = RotatingFileHandler('logs/app.log', maxBytes=LOG_MAX_BYTES, backupCount=10)
 file_handler.setFormatter(logging.Formatter(
     '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
 ))
 file_handler.setLevel(logging.INFO)
-logger.addHandler(file_handler)
+request_log_handler = RotatingFileHandler('logs/requests.log', maxBytes=LOG_MAX_BYTES, backupCount=10)
+request_log_handler.setFormatter(JsonLineFormatter())
+
+app_log_queue = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+request_log_queue = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+logger.addHandler(app_log_queue)
+request_logger = logging.getLogger('ridewave.requests')
+request_logger.setLevel(logging.INFO)
+request_logger.propagate = False
+request_logger.addHandler(request_log_queue)
+
+log_listeners = [
+    QueueListener(app_log_queue.queue, file_handler, respect_handler_level=True),
+    QueueListener(request_log_queue.queue, request_log_handler)
+]
+for listener in log_listeners:
+    listener.start()
+    atexit.register(listener.stop)
 
 app = Flask(__name__)
 
+def database_url(value):
+    # Railway hands out postgres:// URLs, which SQLAlchemy no longer accepts
+    if value.startswith('postgres://'):
+        value = value.replace('postgres://', 'postgresql://', 1)
+    return value
+
 # Configure database URL for Railway
-if os.getenv('DATABASE_URL'):
-    # Parse the DATABASE_URL
-    db_url = os.getenv('DATABASE_URL')
-    if db_url.startswith('postgres://'):
-        db_url = db_url.replace('postgres://', 'postgresql://', 1)
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url
-    logger.info(f"Using PostgreSQL database: {db_url}")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///ridewave.db'
-    logger.info("Using SQLite database")
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url(os.getenv('DATABASE_URL', 'sqlite:///ridewave.db'))
+DATABASE_REPLICA_URL = database_url(os.getenv('DATABASE_REPLICA_URL', '')) or None
+logger.info(f"Using database: {make_url(app.config['SQLALCHEMY_DATABASE_URI']).render_as_string(hide_password=True)}")
 
 # Configure secret key
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', os.urandom(24))
@@ -48,59 +150,293 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', os.urandom(24))
 # Configure SQLAlchemy
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+class MeasuredQueuePool(QueuePool):
+    # QueuePool that also counts checkouts which found every connection in
+    # use and had to wait, and how many of those gave up at pool_timeout
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_lock = threading.Lock()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.wait_timeouts = 0
+
+    def _do_get(self):
+        if self.checkedin() or self._max_overflow < 0 or self.overflow() < self._max_overflow:
+            return super()._do_get()
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            with self.wait_lock:
+                self.waits += 1
+                self.wait_seconds += time.perf_counter() - started
+                self.wait_timeouts += timed_out
+
+# Database engines
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '32768'))
+# Seconds a client keeps reading from the primary after it wrote, so it
+# sees its own booking before the replica has caught up
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', '10'))
+
+def engine_options(url, read_only=False):
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            # SQLAlchemy's own pool keeps a memory database on one connection
+            return {}
+        # Connections are just file handles: no server to size the pool for
+        # or to recycle against, only how long to wait for a free one
+        return {'poolclass': MeasuredQueuePool, 'pool_timeout': 30}
+    options = {
+        'poolclass': MeasuredQueuePool,
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'pool_recycle': 1800
+    }
+    if read_only and url.get_backend_name() == 'postgresql':
+        # A replica route that tries to write fails loudly instead of on the replica's terms
+        options['connect_args'] = {'options': '-c default_transaction_read_only=on'}
+    return options
+
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL lets readers run while a booking is being written; NORMAL sync
+    # is durable across application crashes and only fsyncs at checkpoints
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in ('journal_mode=WAL', 'synchronous=NORMAL', f'busy_timeout={SQLITE_BUSY_TIMEOUT_MS}',
+                   f'mmap_size={SQLITE_MMAP_SIZE}', f'cache_size=-{SQLITE_CACHE_SIZE_KB}'):
+        cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
+
 # Initialize database with connection pooling
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_size': 5,
-    'max_overflow': 10,
-    'pool_timeout': 30,
-    'pool_recycle': 1800
-}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+if DATABASE_REPLICA_URL:
+    app.config['SQLALCHEMY_BINDS'] = {
+        'replica': {'url': DATABASE_REPLICA_URL, **engine_options(DATABASE_REPLICA_URL, read_only=True)}
+    }
+
+class RoutingSession(FlaskSQLAlchemySession):
+    # Views marked @read_replica read from the replica bind when one is
+    # configured. Flushes, and so every write, always use the primary.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_request_context()
+                and g.get('read_replica') and 'replica' in self._db.engines):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+def read_replica(view):
+    # Route this view's reads to the replica, unless the client wrote
+    # recently and the replica may not have its changes yet
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_replica = DATABASE_REPLICA_URL is not None and session.get('primary_until', 0) <= time.time()
+        return view(*args, **kwargs)
+    return wrapper
+
+@event.listens_for(Session, 'after_flush')
+def _remember_request_writes(session, flush_context):
+    if has_request_context():
+        g.wrote_to_primary = True
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    user_cache.sync()
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        # Attach a copy to this request's session without a query
+        return db.session.merge(cached, load=False)
+    user = db.session.get(User, user_id)
+    if user is not None:
+        user_cache.put(user)
+    return user
+
+# Password hashing
+class PasswordHasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    # Runs Werkzeug's deliberately slow hashing on a small process pool so it
+    # does not hold a web worker. At most `max_pending` hashes may be queued
+    # or running; callers beyond that get PasswordHasherBusy straight away.
+    def __init__(self, method, workers=2, max_pending=8, timeout=10):
+        self.method = method
+        # What Werkzeug writes before the first '$' for this method, with the
+        # defaults of an abbreviated one ('scrypt', 'pbkdf2:sha256') filled in
+        self._prefix = generate_password_hash('', method).split('$', 1)[0]
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        # Created on first use so every gunicorn worker gets its own pool.
+        # By then the worker runs several threads, and forking a threaded
+        # process can copy a held lock into the child, so children start
+        # from a fresh interpreter instead.
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context(method))
+        return self._pool
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            future = self._get_pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash finishes, even if this caller
+        # stops waiting for it, so max_pending bounds the pool's backlog
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self._prefix
+
+password_hasher = PasswordHasher(
+    method=os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),
+    workers=int(os.getenv('PASSWORD_HASH_WORKERS', '2')),
+    max_pending=int(os.getenv('PASSWORD_HASH_MAX_PENDING', '8')),
+    timeout=float(os.getenv('PASSWORD_HASH_TIMEOUT', '10'))
+)
+
+def hasher_busy_response(template):
+    flash('We are handling a lot of sign-ins right now, please try again in a moment')
+    response = app.make_response((render_template(template), 503))
+    response.headers['Retry-After'] = '2'
+    return response
 
 # Database Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(256))
     phone = db.Column(db.String(20))
     is_driver = db.Column(db.Boolean, default=False)
     is_admin = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Last reported position of a driver; only online drivers are matched
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    is_online = db.Column(db.Boolean, default=False)
     rides = db.relationship('Ride', foreign_keys='Ride.user_id', backref='user', lazy=True)
     driver_rides = db.relationship('Ride', foreign_keys='Ride.driver_id', backref='driver', lazy=True)
     loyalty = db.relationship('UserLoyalty', backref='user', uselist=False)
 
 class Bike(db.Model):
+    # Columns only the detail page shows are deferred: list pages and
+    # ride.bike loads skip them, bike_detail() undefers the 'detail' group
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    description = db.Column(db.Text, nullable=False)
+    description = db.deferred(db.Column(db.Text, nullable=False), group='detail')
     price = db.Column(db.Float, nullable=False)
     image = db.Column(db.String(200), nullable=False)
     engine = db.Column(db.String(50))
     power = db.Column(db.String(50))
     mileage = db.Column(db.String(50))
     type = db.Column(db.String(50))  # Sport, Cruiser, Touring, etc.
-    gallery_images = db.Column(db.JSON)
+    gallery_images = db.deferred(db.Column(db.JSON), group='detail')
     is_available = db.Column(db.Boolean, default=True)
     min_kms = db.Column(db.Integer, nullable=False)
     is_premium = db.Column(db.Boolean, default=False)
-    features = db.Column(db.JSON)  # Premium features like ABS, Traction Control, etc.
-    specifications = db.Column(db.JSON)  # Detailed specs
+    features = db.deferred(db.Column(db.JSON), group='detail')  # Premium features like ABS, Traction Control, etc.
+    specifications = db.deferred(db.Column(db.JSON), group='detail')  # Detailed specs
     safety_rating = db.Column(db.Float)  # Safety rating out of 5
     comfort_rating = db.Column(db.Float)  # Comfort rating out of 5
     performance_rating = db.Column(db.Float)  # Performance rating out of 5
-    maintenance_history = db.Column(db.JSON)  # Service history
     last_service_date = db.Column(db.DateTime)
     next_service_date = db.Column(db.DateTime)
     service_interval = db.Column(db.Integer)  # Service interval in kilometers
+    kms_since_service = db.Column(db.Integer, default=0)  # Completed ride kms, see _accumulate_service_kms()
+    service_due_at = db.Column(db.DateTime)  # See service_due_date()
+    in_maintenance = db.Column(db.Boolean, default=False)  # Taken out of the fleet by pull_due_bikes()
+    image_variants = db.Column(db.JSON)  # Resized copies of `image`, see build_image_variants()
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    maintenance_history = db.relationship('BikeService', order_by='BikeService.date', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_bike_is_available', 'is_available'),
+        db.Index('ix_bike_available_price', 'is_available', 'price'),
+        # The due queue: the maintenance sweep reads the first, the
+        # due-soon listing the second
+        db.Index('ix_bike_available_service_due', 'is_available', 'service_due_at'),
+        db.Index('ix_bike_service_due_at', 'service_due_at'),
+        # Bikes out for service, counted by the dashboard and its snapshot
+        db.Index('ix_bike_in_maintenance', 'in_maintenance'),
+    )
+
+class BikeService(db.Model):
+    # Append-only service log. It used to be a JSON list on the bike row,
+    # which every bike load read and every service made longer.
+    __tablename__ = 'bike_service'
+    id = db.Column(db.Integer, primary_key=True)
+    bike_id = db.Column(db.Integer, db.ForeignKey('bike.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    service = db.Column(db.String(100), nullable=False)
+    kms = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_bike_service_bike_date', 'bike_id', 'date'),
+    )
+
+# What catalog cards, admin rows and ride summaries show of a bike
+BIKE_LIST_COLUMNS = ('name', 'type', 'price', 'image', 'image_variants', 'engine', 'power', 'mileage',
+                     'min_kms', 'is_available', 'is_premium')
+
+def bike_list_query(*extra_columns):
+    return Bike.query.options(db.load_only(*(getattr(Bike, name) for name in BIKE_LIST_COLUMNS + extra_columns)))
+
+def service_fields(entry):
+    # A {'date': 'YYYY-MM-DD', 'service': ..., 'kms': ...} history entry
+    return {'date': datetime.strptime(entry['date'], '%Y-%m-%d').date(), 'service': entry['service'],
+            'kms': entry.get('kms')}
+
+def record_bike_service(bike, date, service, kms=None):
+    # Services are only ever appended; the bike row just tracks the latest.
+    # The latest one restarts the kms count and schedules the next service,
+    # and a bike the maintenance sweep pulled goes back into the fleet.
+    db.session.add(BikeService(bike_id=bike.id, date=date, service=service, kms=kms))
+    if bike.last_service_date is None or bike.last_service_date.date() <= date:
+        bike.last_service_date = datetime.combine(date, datetime.min.time())
+        bike.next_service_date = bike.last_service_date + timedelta(days=MAINTENANCE_SERVICE_DAYS)
+        bike.kms_since_service = 0
+        if bike.in_maintenance:
+            bike.in_maintenance = False
+            bike.is_available = True
 
 class LoyaltyTier(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -114,6 +450,11 @@ class UserLoyalty(db.Model):
     points = db.Column(db.Integer, default=0)
     tier_id = db.Column(db.Integer, db.ForeignKey('loyalty_tier.id'))
     tier = db.relationship('LoyaltyTier', backref='user_loyalties')
+
+    __table_args__ = (
+        # One row per user, which the set-based accrual upserts rely on
+        db.Index('ux_user_loyalty_user_id', 'user_id', unique=True),
+    )
     
 class Accessory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -132,7 +473,8 @@ class Ride(db.Model):
     pickup_location = db.Column(db.String(200), nullable=False)
     dropoff_location = db.Column(db.String(200), nullable=False)
     date = db.Column(db.DateTime, nullable=False)
-    status = db.Column(db.String(20), default='pending')
+    # Old values are loaded on change so the session hooks see transitions
+    status = db.column_property(db.Column(db.String(20), default='pending'), active_history=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     driver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     bike_id = db.Column(db.Integer, db.ForeignKey('bike.id'), nullable=False)
@@ -150,8 +492,22 @@ class Ride(db.Model):
     accessories = db.relationship('Accessory', secondary='ride_accessory', backref='rides')
     loyalty_points_earned = db.Column(db.Integer)
     applied_discount = db.Column(db.Float)
+    refund_amount = db.Column(db.Float)
+    pickup_latitude = db.Column(db.Float)
+    pickup_longitude = db.Column(db.Float)
+    dropoff_latitude = db.Column(db.Float)
+    dropoff_longitude = db.Column(db.Float)
     bike = db.relationship('Bike', backref='rides')
 
+    __table_args__ = (
+        db.Index('ix_ride_user_pickup', 'user_id', 'pickup_date'),
+        db.Index('ix_ride_status_pickup', 'status', 'pickup_date'),
+        db.Index('ix_ride_pickup_date', 'pickup_date'),
+        db.Index('ix_ride_driver_id', 'driver_id'),
+        # Covers the per-user totals of the loyalty recompute
+        db.Index('ix_ride_user_points', 'user_id', 'loyalty_points_earned'),
+    )
+
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(50), unique=True, nullable=False)
@@ -161,8 +517,7 @@ class Settings(db.Model):
 
     @staticmethod
     def get_value(key, default=None):
-        setting = Settings.query.filter_by(key=key).first()
-        return setting.value if setting else default
+        return settings_cache.get(key, default)
 
     @staticmethod
     def set_value(key, value, description=None):
@@ -174,22 +529,2322 @@ class Settings(db.Model):
         else:
             setting = Settings(key=key, value=value, description=description)
             db.session.add(setting)
+        # Bumping the version in the same transaction tells other workers to reload
+        version = CacheVersion.bump('settings')
         db.session.commit()
+        settings_cache.store(key, value, version)
+
+class CacheVersion(db.Model):
+    # Named counters that workers poll to find out a cache went stale
+    __tablename__ = 'cache_version'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @staticmethod
+    def current(name):
+        return db.session.query(CacheVersion.version).filter_by(name=name).scalar() or 0
+
+    @staticmethod
+    def bump(name, connection=None):
+        # Atomic increment inside the caller's transaction; does not commit
+        connection = connection or db.session.connection()
+        dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+        now = datetime.utcnow()
+        stmt = dialect.insert(CacheVersion.__table__).values(name=name, version=1, updated_at=now)
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'version': CacheVersion.__table__.c.version + 1, 'updated_at': now}
+        ))
+        return connection.execute(
+            db.select(CacheVersion.version).where(CacheVersion.name == name)
+        ).scalar()
+
+class SettingsCache:
+    # All settings are held in memory and loaded with one query. The shared
+    # version stamp is checked at most once per `check_interval` seconds.
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._values = None
+        self._version = None
+        self._checked_at = 0
+
+    def _reload(self, version):
+        values = dict(db.session.query(Settings.key, Settings.value).all())
+        with self._lock:
+            self._values = values
+            self._version = version
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        if self._values is None or now - self._checked_at > self.check_interval:
+            self._checked_at = now
+            version = CacheVersion.current('settings')
+            if self._values is None or version != self._version:
+                self._reload(version)
+        return self._values.get(key, default)
+
+    def store(self, key, value, version):
+        with self._lock:
+            if self._values is None:
+                return
+            values = dict(self._values)
+            values[key] = value
+            self._values = values
+            # Only skip the next reload if nothing else changed in between
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+            else:
+                self._values = None
+
+    def clear(self):
+        with self._lock:
+            self._values = None
+            self._version = None
+
+settings_cache = SettingsCache(check_interval=float(os.getenv('SETTINGS_CACHE_CHECK_INTERVAL', '5')))
+
+class CatalogCache:
+    # Rendered catalog pages keyed by page and nav variant. Everything is
+    # dropped when the shared 'catalog' version moves, which is checked at
+    # most once per `check_interval` seconds.
+    def __init__(self, check_interval=5, max_pages=1000):
+        self.check_interval = check_interval
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._version = None
+        self._checked_at = 0
+        self.last_modified = datetime.utcnow().replace(microsecond=0)
+
+    def sync(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at <= self.check_interval:
+            return
+        self._checked_at = now
+        row = db.session.query(CacheVersion.version, CacheVersion.updated_at).filter_by(name='catalog').first()
+        version, updated_at = row if row else (0, None)
+        if version != self._version:
+            with self._lock:
+                self._pages.clear()
+                self._version = version
+                if updated_at:
+                    self.last_modified = updated_at.replace(microsecond=0)
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, body):
+        page = (body, hashlib.sha1(body.encode('utf-8')).hexdigest())
+        with self._lock:
+            self._pages[key] = page
+            if len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+        return page
+
+catalog_cache = CatalogCache(check_interval=float(os.getenv('CATALOG_CACHE_CHECK_INTERVAL', '5')))
+
+class UserCache:
+    # Bounded LRU of loaded users with a TTL. Entries are detached copies
+    # holding only column values; role changes and deletes bump the shared
+    # 'users' version, which clears the cache in every worker.
+    def __init__(self, max_size=10000, ttl=60, check_interval=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (expires_at, user)
+        self._version = None
+        self._checked_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def sync(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at <= self.check_interval:
+            return
+        self._checked_at = now
+        version = CacheVersion.current('users')
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user):
+        copy = User(**{column.key: getattr(user, column.key) for column in User.__table__.columns})
+        make_transient_to_detached(copy)
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl, copy)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None
+        }
+
+user_cache = UserCache(
+    max_size=int(os.getenv('USER_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('USER_CACHE_TTL', '60'))
+)
+
+def cached_catalog_page(name, render):
+    # The nav in base.html is the only part of a catalog page that depends
+    # on the visitor, so cache one copy per nav variant
+    catalog_cache.sync()
+    key = (name, bool(session.get('user_id')), bool(session.get('is_driver')))
+    page = catalog_cache.get(key)
+    if page is None:
+        # Everyone is served this copy until the next catalog change, so
+        # build it from the primary rather than a possibly lagging replica
+        g.read_replica = False
+        page = catalog_cache.put(key, render())
+    body, etag = page
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.last_modified = catalog_cache.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+class Booking(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    bike_id = db.Column(db.Integer, db.ForeignKey('bike.id'), nullable=False)
+    start_date = db.Column(db.DateTime, nullable=False)
+    end_date = db.Column(db.DateTime, nullable=False)
+    total_price = db.Column(db.Float, nullable=False)
+    status = db.column_property(db.Column(db.String(20), default='pending'), active_history=True)  # pending, confirmed, cancelled, completed
+    payment_status = db.Column(db.String(20), default='pending')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    user = db.relationship('User', backref='bookings')
+    bike = db.relationship('Bike', backref='bookings')
+
+    __table_args__ = (
+        # Only active bookings can conflict, so the index skips cancelled ones
+        db.Index('ix_booking_bike_active', 'bike_id', 'start_date', 'end_date',
+                 sqlite_where=db.text("status != 'cancelled'"),
+                 postgresql_where=db.text("status != 'cancelled'")),
+        # Lets the availability index load current bookings without reading past ones
+        db.Index('ix_booking_active_end', 'end_date',
+                 sqlite_where=db.text("status != 'cancelled'"),
+                 postgresql_where=db.text("status != 'cancelled'")),
+        db.Index('ix_booking_user_id', 'user_id'),
+    )
+
+class Receipt(db.Model):
+    # Written by the 'receipt' job after a booking or a refund. Receipts are
+    # financial records, so they outlive the booking or ride they describe.
+    __tablename__ = 'receipt'
+    id = db.Column(db.Integer, primary_key=True)
+    number = db.Column(db.String(50), unique=True, nullable=False)  # booking-<id>, refund-<ride id>
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False)
+    items = db.Column(db.JSON, nullable=False)  # [{'description', 'amount'}]
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Job(db.Model):
+    # Durable background work, enqueued in the transaction of the change
+    # that needs it and run by `flask jobs-worker`
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    idempotency_key = db.Column(db.String(200), unique=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+class JobCheckpoint(db.Model):
+    # Progress of a resumable batch job: the next key to process
+    __tablename__ = 'job_checkpoint'
+    name = db.Column(db.String(50), primary_key=True)
+    phase = db.Column(db.String(20))
+    position = db.Column(db.Integer, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class DailyMetrics(db.Model):
+    # One rollup row per day, kept current by the session hooks below and
+    # rebuilt from history with `flask metrics-backfill`
+    __tablename__ = 'daily_metrics'
+    day = db.Column(db.Date, primary_key=True)
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+    completed_revenue = db.Column(db.Float, nullable=False, default=0)
+    new_users = db.Column(db.Integer, nullable=False, default=0)
+    maintenance_bikes = db.Column(db.Integer, nullable=False, default=0)
+
+class BookingSlot(db.Model):
+    # One row per bike per booked day. The primary key makes overlapping
+    # bookings of the same bike impossible without locking anything else.
+    __tablename__ = 'booking_slot'
+    bike_id = db.Column(db.Integer, db.ForeignKey('bike.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id', ondelete='CASCADE'), nullable=False, index=True)
+
+# Reservations
+class BikeUnavailable(Exception):
+    pass
+
+def booking_days(start_date, end_date):
+    # Days touched by the half-open range [start_date, end_date)
+    day = start_date.date()
+    while datetime.combine(day, datetime.min.time()) < end_date:
+        yield day
+        day += timedelta(days=1)
+
+def slot_rows(booking_id, bike_id, start_date, end_date):
+    return [{'bike_id': bike_id, 'day': day, 'booking_id': booking_id}
+            for day in booking_days(start_date, end_date)]
+
+def reserve_bike(user_id, bike_id, start_date, end_date, total_price, attempts=3, on_reserved=None):
+    # Optimistic: insert the booking and its slots and let the slot primary
+    # key reject a concurrent overlap. Lock timeouts are retried with backoff.
+    # on_reserved(booking) runs before the commit, so jobs it queues commit
+    # with the booking.
+    for attempt in range(attempts):
+        try:
+            booking = Booking(
+                user_id=user_id,
+                bike_id=bike_id,
+                start_date=start_date,
+                end_date=end_date,
+                total_price=total_price,
+                status='pending'
+            )
+            db.session.add(booking)
+            db.session.flush()
+            db.session.execute(
+                BookingSlot.__table__.insert(),
+                slot_rows(booking.id, bike_id, start_date, end_date)
+            )
+            if on_reserved:
+                on_reserved(booking)
+            db.session.commit()
+            return booking
+        except IntegrityError:
+            db.session.rollback()
+            raise BikeUnavailable()
+        except OperationalError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, 0.02 * 2 ** attempt))
+
+@event.listens_for(Session, 'after_flush')
+def _sync_booking_slots(session, flush_context):
+    # Free the slots of cancelled or deleted bookings in the same
+    # transaction, and claim them again if a booking is reinstated
+    connection = None
+    for obj in session.dirty.union(session.deleted):
+        if not isinstance(obj, Booking):
+            continue
+        status = get_history(obj, 'status')
+        old_status = status.deleted[0] if status.deleted else obj.status
+        cancelled = obj in session.deleted or obj.status == 'cancelled'
+        if cancelled == (old_status == 'cancelled'):
+            continue
+        connection = connection or session.connection()
+        table = BookingSlot.__table__
+        if cancelled:
+            connection.execute(table.delete().where(table.c.booking_id == obj.id))
+        else:
+            connection.execute(table.insert(), slot_rows(obj.id, obj.bike_id, obj.start_date, obj.end_date))
+
+def backfill_booking_slots():
+    # Claim slots for existing active bookings; pre-existing double bookings
+    # keep whichever booking claimed the day first
+    connection = db.session.connection()
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    bookings = db.session.query(
+        Booking.id, Booking.bike_id, Booking.start_date, Booking.end_date
+    ).filter(Booking.status != 'cancelled').order_by(Booking.id)
+    count = 0
+    for booking in bookings:
+        rows = slot_rows(*booking)
+        if rows:
+            connection.execute(dialect.insert(BookingSlot.__table__).on_conflict_do_nothing(), rows)
+            count += 1
+    db.session.commit()
+    return count
+
+def create_stress_fixtures(bikes, drivers=0):
+    # A throwaway user, bikes and drivers for the stress commands
+    tag = uuid.uuid4().hex[:8]
+    user = User(username=f'stress-{tag}', email=f'stress-{tag}@example.invalid', password_hash='!')
+    # Created unavailable so they never show up in the catalog
+    stress_bikes = [Bike(name=f'Stress bike {i}', description='Stress test bike', price=0,
+                         image='', min_kms=0, is_available=False) for i in range(bikes)]
+    stress_drivers = [User(username=f'stress-{tag}-driver-{i}', email=f'stress-{tag}-{i}@example.invalid',
+                           password_hash='!', is_driver=True) for i in range(drivers)]
+    db.session.add(user)
+    db.session.add_all(stress_bikes)
+    db.session.add_all(stress_drivers)
+    db.session.commit()
+    return user, stress_bikes, stress_drivers
+
+def delete_stress_fixtures(user, stress_bikes, stress_drivers=()):
+    for obj in [*stress_bikes, *stress_drivers, user]:
+        db.session.delete(obj)
+    db.session.commit()
+
+@app.cli.command('booking-stress')
+@click.option('--threads', default=16, help='Concurrent booking threads')
+@click.option('--attempts', default=2000, help='Total booking attempts')
+@click.option('--bikes', default=5, help='Bikes the attempts compete for')
+@click.option('--days', default=60, help='Window of days the random bookings fall in')
+@click.option('--keep', is_flag=True, help='Keep the generated rows afterwards')
+def booking_stress_command(threads, attempts, bikes, days, keep):
+    """Race reserve_bike() from many threads and check for double bookings."""
+    user, stress_bikes, _ = create_stress_fixtures(bikes)
+    user_id = user.id
+    bike_ids = [bike.id for bike in stress_bikes]
+    
+    # Far enough ahead not to collide with real bookings
+    base = datetime.combine(datetime.utcnow().date() + timedelta(days=3650), datetime.min.time())
+    counter = itertools.count()
+    results = {'booked': 0, 'conflicts': 0, 'errors': 0}
+    results_lock = threading.Lock()
+    
+    def worker():
+        rng = random.Random()
+        with app.app_context():
+            while next(counter) < attempts:
+                start = base + timedelta(days=rng.randrange(days))
+                end = start + timedelta(days=rng.randint(1, 5))
+                try:
+                    reserve_bike(user_id, rng.choice(bike_ids), start, end, 0)
+                    outcome = 'booked'
+                except BikeUnavailable:
+                    outcome = 'conflicts'
+                except OperationalError:
+                    outcome = 'errors'
+                with results_lock:
+                    results[outcome] += 1
+    
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    
+    first, second = db.aliased(Booking), db.aliased(Booking)
+    double_bookings = db.session.query(db.func.count()).select_from(first).join(second, db.and_(
+        first.bike_id == second.bike_id,
+        first.id < second.id,
+        first.start_date < second.end_date,
+        second.start_date < first.end_date
+    )).filter(
+        first.bike_id.in_(bike_ids),
+        first.status != 'cancelled',
+        second.status != 'cancelled'
+    ).scalar()
+    
+    click.echo(json.dumps({
+        'database': db.engine.dialect.name,
+        'threads': threads,
+        'attempts': attempts,
+        **results,
+        'double_bookings': double_bookings,
+        'seconds': round(elapsed, 3),
+        'bookings_per_second': round(results['booked'] / elapsed, 1),
+        'attempts_per_second': round(attempts / elapsed, 1)
+    }, indent=2))
+    
+    if not keep:
+        BookingSlot.query.filter(BookingSlot.bike_id.in_(bike_ids)).delete(synchronize_session=False)
+        Booking.query.filter(Booking.bike_id.in_(bike_ids)).delete(synchronize_session=False)
+        delete_stress_fixtures(user, stress_bikes)
+    if double_bookings:
+        sys.exit(1)
+
+@app.cli.command('dispatch-stress')
+@click.option('--drivers', default=300, help='Simulated drivers claiming rides')
+@click.option('--rides', default=500, help='Pending rides to dispatch')
+@click.option('--threads', default=32, help='Concurrent claiming threads')
+@click.option('--keep', is_flag=True, help='Keep the generated rows afterwards')
+def dispatch_stress_command(drivers, rides, threads, keep):
+    """Race many drivers for pending rides and check each ride has one winner."""
+    user, stress_bikes, stress_drivers = create_stress_fixtures(1, drivers)
+    driver_ids = [driver.id for driver in stress_drivers]
+    pickup = datetime.utcnow() + timedelta(days=3650)
+    db.session.execute(Ride.__table__.insert(), [{
+        'user_id': user.id, 'bike_id': stress_bikes[0].id, 'pickup_location': 'Stress',
+        'dropoff_location': 'Stress', 'date': pickup, 'pickup_date': pickup + timedelta(minutes=i),
+        'dropoff_date': pickup + timedelta(days=1), 'estimated_kms': 0, 'total_price': 0,
+        'security_deposit': 0, 'insurance_type': 'basic', 'license_number': 'STRESS',
+        'riding_experience': 0, 'status': 'pending'
+    } for i in range(rides)])
+    db.session.commit()
+    ride_ids = [ride_id for ride_id, in db.session.query(Ride.id).filter_by(user_id=user.id)]
+    
+    # Each driver goes after a random handful of rides, so popular rides are contested
+    attempts = queue.Queue()
+    rng = random.Random()
+    for driver_id in driver_ids:
+        for ride_id in rng.sample(ride_ids, min(len(ride_ids), 10)):
+            attempts.put((driver_id, ride_id))
+    wins = {}
+    results = {'attempts': attempts.qsize(), 'claimed': 0, 'lost': 0, 'errors': 0}
+    results_lock = threading.Lock()
+    
+    def worker():
+        with app.app_context():
+            while True:
+                try:
+                    driver_id, ride_id = attempts.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    outcome = 'claimed' if claim_ride(ride_id, driver_id) else 'lost'
+                except OperationalError:
+                    db.session.rollback()
+                    outcome = 'errors'
+                with results_lock:
+                    results[outcome] += 1
+                    if outcome == 'claimed':
+                        wins[ride_id] = wins.get(ride_id, 0) + 1
+    
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    
+    owners = dict(db.session.query(Ride.id, Ride.driver_id).filter(Ride.id.in_(ride_ids)))
+    double_claims = sum(1 for count in wins.values() if count > 1)
+    mismatched = sum(1 for ride_id in wins if owners.get(ride_id) not in driver_ids)
+    
+    click.echo(json.dumps({
+        'database': db.engine.dialect.name,
+        'drivers': drivers,
+        'rides': rides,
+        'threads': threads,
+        **results,
+        'double_claims': double_claims,
+        'unowned_claims': mismatched,
+        'seconds': round(elapsed, 3),
+        'attempts_per_second': round(results['attempts'] / elapsed, 1)
+    }, indent=2))
+    
+    if not keep:
+        # The stress rides went in through Core, so they never reached the
+        # daily rollups and must not be subtracted from them either
+        DispatchEvent.query.filter(DispatchEvent.ride_id.in_(ride_ids)).delete(synchronize_session=False)
+        Ride.query.filter(Ride.id.in_(ride_ids)).delete(synchronize_session=False)
+        delete_stress_fixtures(user, stress_bikes, stress_drivers)
+    if double_claims or mismatched:
+        sys.exit(1)
+
+# Pricing engine
+INSURANCE_RATES = {'basic': 500, 'premium': 1000}  # per day
+TRAINING_FEE = 2000
+QUOTE_MAX_CELLS = 5000
+
+def quote_prices(bike_prices, durations, insurance='basic', training=False,
+                 accessories_per_day=0.0, discount_percentage=0.0):
+    # Price every bike for every duration at once: bikes run along the rows
+    # and durations (in days) along the columns of each returned array
+    if insurance not in INSURANCE_RATES:
+        raise ValueError(f'Unknown insurance type: {insurance}')
+    prices = np.asarray(bike_prices, dtype=float)[:, np.newaxis]
+    days = np.asarray(durations, dtype=float)[np.newaxis, :]
+    shape = (prices.shape[0], days.shape[1])
+    
+    base = prices * days
+    insurance_cost = np.broadcast_to(INSURANCE_RATES[insurance] * days, shape)
+    accessories_cost = np.broadcast_to(accessories_per_day * days, shape)
+    training_cost = np.full(shape, float(TRAINING_FEE) if training else 0.0)
+    subtotal = base + insurance_cost + accessories_cost + training_cost
+    discount = subtotal * (discount_percentage / 100)
+    return {
+        'base_price': base,
+        'insurance_price': insurance_cost,
+        'accessories_price': accessories_cost,
+        'training_price': training_cost,
+        'discount': discount,
+        'total_price': np.round(subtotal - discount, 2)
+    }
+
+# Loyalty engine
+class LoyaltyTierTable:
+    # Tiers sorted by min_points, so finding a user's tier is one bisect.
+    # Entries are (id, name, min_points, discount_percentage). Reloaded when
+    # the shared 'loyalty_tiers' version moves, checked every `check_interval`.
+    def __init__(self, check_interval=30):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._tiers = []
+        self._thresholds = []
+        self._version = None
+        self._checked_at = 0
+
+    def sync(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at <= self.check_interval:
+            return
+        self._checked_at = now
+        version = CacheVersion.current('loyalty_tiers')
+        if version == self._version:
+            return
+        tiers = [tuple(row) for row in db.session.query(
+            LoyaltyTier.id, LoyaltyTier.name, LoyaltyTier.min_points, LoyaltyTier.discount_percentage
+        ).order_by(LoyaltyTier.min_points, LoyaltyTier.id)]
+        with self._lock:
+            self._tiers = tiers
+            self._thresholds = [tier[2] for tier in tiers]
+            self._version = version
+
+    def tier_for(self, points):
+        self.sync()
+        with self._lock:
+            position = bisect_right(self._thresholds, points or 0)
+            return self._tiers[position - 1] if position else None
+
+    def tiers(self):
+        self.sync()
+        with self._lock:
+            return list(self._tiers)
+
+    def clear(self):
+        with self._lock:
+            self._version = None
+
+loyalty_tier_table = LoyaltyTierTable(check_interval=float(os.getenv('LOYALTY_TIER_CHECK_INTERVAL', '30')))
+
+def tier_id_case(points, tiers):
+    # The tier lookup as a SQL CASE, for re-tiering many rows in one statement
+    if not tiers:
+        return db.null()
+    return db.case(*[(points >= min_points, tier_id) for tier_id, _, min_points, _ in reversed(tiers)],
+                   else_=db.null())
+
+@event.listens_for(Session, 'after_flush')
+def _bump_loyalty_tiers_version(session, flush_context):
+    if any(isinstance(obj, LoyaltyTier) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        CacheVersion.bump('loyalty_tiers', session.connection())
+        session.info['loyalty_tiers_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _reload_loyalty_tiers(session):
+    if session.info.pop('loyalty_tiers_changed', None):
+        loyalty_tier_table.clear()
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_loyalty_tier_changes(session):
+    session.info.pop('loyalty_tiers_changed', None)
+
+def loyalty_points_rate():
+    return float(Settings.get_value('points_per_100', '10'))
+
+def loyalty_discount(user):
+    if not user.is_authenticated:
+        return 0.0
+    points = db.session.query(UserLoyalty.points).filter_by(user_id=user.id).scalar()
+    tier = loyalty_tier_table.tier_for(points) if points is not None else None
+    return tier[3] if tier else 0.0
+
+@event.listens_for(Session, 'after_flush')
+def _queue_loyalty_accrual(session, flush_context):
+    # Points are earned when a ride becomes completed and taken back if it
+    # stops being completed or is deleted. The balances are brought up to
+    # date by a 'loyalty_accrual' job rather than in the request.
+    user_ids = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, Ride):
+            continue
+        status = get_history(obj, 'status')
+        old_status = status.deleted[0] if status.deleted else (None if obj in session.new else obj.status)
+        completed = obj.status == 'completed' and obj not in session.deleted
+        if completed != (old_status == 'completed'):
+            user_ids.add(obj.user_id)
+    for user_id in sorted(user_ids):
+        enqueue_job('loyalty_accrual', {'user_id': user_id}, connection=session.connection())
+
+def recompute_ride_points(connection, low, high, rate):
+    # Points earned by rides with low <= id < high; NULL unless completed.
+    # Rows that already hold the right value are skipped, so reruns mostly read.
+    ride = Ride.__table__
+    earned = db.case((ride.c.status == 'completed', db.cast(ride.c.total_price * rate / 100, db.Integer)),
+                     else_=db.null())
+    connection.execute(ride.update().where(
+        ride.c.id >= low, ride.c.id < high, ride.c.loyalty_points_earned.is_distinct_from(earned)
+    ).values(loyalty_points_earned=earned))
+
+def recompute_user_loyalty(connection, low, high, tiers):
+    # Balances and tiers of users with low <= id < high, summed from the
+    # ride points above through the (user_id, loyalty_points_earned) index
+    ride = Ride.__table__
+    loyalty = UserLoyalty.__table__
+    earning = db.and_(ride.c.user_id >= low, ride.c.user_id < high, ride.c.loyalty_points_earned.isnot(None))
+    points = db.func.sum(ride.c.loyalty_points_earned)
+    totals = db.select(ride.c.user_id, points, tier_id_case(points, tiers)).where(earning).group_by(ride.c.user_id)
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    stmt = dialect.insert(loyalty).from_select(['user_id', 'points', 'tier_id'], totals)
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={'points': stmt.excluded.points, 'tier_id': stmt.excluded.tier_id},
+        where=db.or_(loyalty.c.points.is_distinct_from(stmt.excluded.points),
+                     loyalty.c.tier_id.is_distinct_from(stmt.excluded.tier_id))
+    ))
+    
+    # Members left without any completed ride drop back to zero
+    base_tier = tier_id_case(db.literal(0), tiers)
+    connection.execute(loyalty.update().where(
+        loyalty.c.user_id >= low, loyalty.c.user_id < high,
+        db.or_(loyalty.c.points.is_distinct_from(0), loyalty.c.tier_id.is_distinct_from(base_tier)),
+        loyalty.c.user_id.not_in(db.select(ride.c.user_id).where(earning))
+    ).values(points=0, tier_id=base_tier))
+
+def recompute_loyalty(batch_size=100000, restart=False):
+    # Two passes of set-based statements over id ranges: ride points by
+    # ride id, then balances and tiers by user id. Each range commits with
+    # the checkpoint, so an interrupted run resumes where it stopped.
+    name = 'loyalty_recompute'
+    checkpoint = None if restart else db.session.get(JobCheckpoint, name)
+    phase = checkpoint.phase if checkpoint else 'rides'
+    resumed_from = {'phase': phase, 'position': checkpoint.position if checkpoint else 0}
+    started_at = checkpoint.started_at if checkpoint else datetime.utcnow()
+    rate = loyalty_points_rate()
+    tiers = loyalty_tier_table.tiers()
+    passes = [
+        ('rides', Ride.id, lambda connection, low, high: recompute_ride_points(connection, low, high, rate)),
+        ('users', User.id, lambda connection, low, high: recompute_user_loyalty(connection, low, high, tiers)),
+    ]
+    last_ids = {pass_name: db.session.query(db.func.max(column)).scalar() or 0 for pass_name, column, _ in passes}
+    db.session.commit()
+    
+    table = JobCheckpoint.__table__
+    batches = 0
+    for pass_name, _, run in passes[[pass_name for pass_name, _, _ in passes].index(phase):]:
+        start = checkpoint.position if checkpoint and pass_name == phase else 0
+        for low in range(start, last_ids[pass_name] + 1, batch_size):
+            high = low + batch_size
+            with db.engine.begin() as connection:
+                run(connection, low, high)
+                dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+                stmt = dialect.insert(table).values(
+                    name=name, phase=pass_name, position=high, started_at=started_at, updated_at=datetime.utcnow()
+                )
+                connection.execute(stmt.on_conflict_do_update(
+                    index_elements=['name'],
+                    set_={'phase': stmt.excluded.phase, 'position': stmt.excluded.position,
+                          'updated_at': stmt.excluded.updated_at}
+                ))
+            batches += 1
+            logger.info(f"Loyalty recompute: {pass_name} up to id {high} of {last_ids[pass_name]}")
+    
+    JobCheckpoint.query.filter_by(name=name).delete()
+    db.session.commit()
+    return {'resumed_from': resumed_from, 'last_ids': last_ids, 'batches': batches}
+
+@app.cli.command('loyalty-recompute')
+@click.option('--batch-size', default=100000, help='User ids per committed batch')
+@click.option('--restart', is_flag=True, help='Ignore any saved checkpoint and start over')
+def loyalty_recompute_command(batch_size, restart):
+    """Recompute every user's loyalty points and tier, resuming if interrupted."""
+    started = time.perf_counter()
+    summary = recompute_loyalty(batch_size, restart)
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    click.echo(json.dumps(summary, indent=2))
+
+class DispatchEvent(db.Model):
+    # Append-only log of rides becoming claimable or being claimed. Each
+    # worker tails it once and fans events out to its connected drivers.
+    __tablename__ = 'dispatch_event'
+    id = db.Column(db.Integer, primary_key=True)
+    ride_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # pending, claimed
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# Driver dispatch
+DISPATCH_POLL_INTERVAL = float(os.getenv('DISPATCH_POLL_INTERVAL', '1'))
+DISPATCH_STREAM_SECONDS = int(os.getenv('DISPATCH_STREAM_SECONDS', '300'))
+# Each open stream holds a worker thread, so only this many per process;
+# drivers beyond it are turned away and poll /driver-rides/updates instead
+DISPATCH_MAX_STREAMS = int(os.getenv('DISPATCH_MAX_STREAMS', '2'))
+DISPATCH_EVENT_RETENTION = timedelta(days=1)
+
+def record_dispatch_events(connection, events):
+    # events: [(ride_id, kind)], written in the caller's transaction
+    if events:
+        now = datetime.utcnow()
+        connection.execute(DispatchEvent.__table__.insert(), [
+            {'ride_id': ride_id, 'kind': kind, 'created_at': now} for ride_id, kind in events
+        ])
+
+@event.listens_for(Session, 'after_flush')
+def _record_ride_dispatch_events(session, flush_context):
+    events = []
+    for obj in session.new:
+        if isinstance(obj, Ride) and obj.status == 'pending':
+            events.append((obj.id, 'pending'))
+    for obj in session.dirty.union(session.deleted):
+        if not isinstance(obj, Ride):
+            continue
+        status = get_history(obj, 'status')
+        old_status = status.deleted[0] if status.deleted else obj.status
+        pending = obj not in session.deleted and obj.status == 'pending'
+        if pending and old_status != 'pending':
+            events.append((obj.id, 'pending'))
+        elif old_status == 'pending' and not pending:
+            events.append((obj.id, 'claimed'))
+    if events:
+        record_dispatch_events(session.connection(), events)
+
+def claim_ride(ride_id, driver_id):
+    # A conditional UPDATE: exactly one concurrent caller sees a row change
+    table = Ride.__table__
+    result = db.session.execute(
+        table.update()
+        .where(table.c.id == ride_id, table.c.status == 'pending')
+        .values(status='accepted', driver_id=driver_id)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        return False
+    record_dispatch_events(db.session.connection(), [(ride_id, 'claimed')])
+    db.session.commit()
+    return True
+
+def claim_next_ride(driver_id):
+    # Claim the earliest pending ride. On Postgres SKIP LOCKED makes
+    # competing drivers pick different rows instead of queueing on one;
+    # SQLite serializes writers, so the statement is atomic there as well.
+    table = Ride.__table__
+    next_pending = db.select(table.c.id).where(table.c.status == 'pending').order_by(
+        table.c.pickup_date, table.c.id
+    ).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+    ride_id = db.session.execute(
+        table.update()
+        .where(table.c.id == next_pending, table.c.status == 'pending')
+        .values(status='accepted', driver_id=driver_id)
+        .returning(table.c.id)
+    ).scalar()
+    if ride_id is None:
+        db.session.rollback()
+        return None
+    record_dispatch_events(db.session.connection(), [(ride_id, 'claimed')])
+    db.session.commit()
+    return ride_id
+
+def dispatch_ride_payload(ride_id, pickup_location, dropoff_location, pickup_date):
+    return {
+        'ride_id': ride_id,
+        'pickup_location': pickup_location,
+        'dropoff_location': dropoff_location,
+        'pickup_date': pickup_date.isoformat() if pickup_date else None
+    }
+
+class DispatchHub:
+    # One background thread per worker tails dispatch_event and pushes new
+    # events to every connected driver's queue, so the database sees one
+    # poll per worker instead of one per driver.
+    def __init__(self, poll_interval=1.0, buffer_size=1000, subscriber_queue_size=1000, max_subscribers=None):
+        self.poll_interval = poll_interval
+        self.subscriber_queue_size = subscriber_queue_size
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._recent = deque(maxlen=buffer_size)
+        self._last_id = None
+        self._thread = None
+        self._polls = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='dispatch-hub', daemon=True)
+                self._thread.start()
+
+    def subscribe(self):
+        # None once max_subscribers streams are open
+        subscription = queue.Queue(maxsize=self.subscriber_queue_size)
+        with self._lock:
+            if self.max_subscribers is not None and len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def replay(self, since_id):
+        # Events after `since_id`, or None if some of them are no longer buffered
+        with self._lock:
+            if since_id == self._last_id:
+                return []
+            if not self._recent or since_id < self._recent[0]['id'] - 1:
+                return None
+            return [event for event in self._recent if event['id'] > since_id]
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                try:
+                    self._poll()
+                except Exception as e:
+                    logger.error(f"Dispatch poll failed: {str(e)}")
+                    db.session.rollback()
+                time.sleep(self.poll_interval)
+
+    def _poll(self):
+        if self._last_id is None:
+            self._last_id = db.session.query(db.func.max(DispatchEvent.id)).scalar() or 0
+        rows = db.session.query(
+            DispatchEvent.id, DispatchEvent.kind, DispatchEvent.ride_id,
+            Ride.pickup_location, Ride.dropoff_location, Ride.pickup_date
+        ).outerjoin(Ride, Ride.id == DispatchEvent.ride_id).filter(
+            DispatchEvent.id > self._last_id
+        ).order_by(DispatchEvent.id).limit(500).all()
+        
+        self._polls += 1
+        if self._polls % 3600 == 0:
+            DispatchEvent.query.filter(
+                DispatchEvent.created_at < datetime.utcnow() - DISPATCH_EVENT_RETENTION
+            ).delete(synchronize_session=False)
+        # End the read transaction so the next poll sees new commits
+        db.session.commit()
+        
+        for event_id, kind, ride_id, pickup_location, dropoff_location, pickup_date in rows:
+            event = dispatch_ride_payload(ride_id, pickup_location, dropoff_location, pickup_date)
+            event.update(id=event_id, kind=kind)
+            with self._lock:
+                self._recent.append(event)
+                self._last_id = event_id
+                subscribers = list(self._subscribers)
+            for subscription in subscribers:
+                try:
+                    subscription.put_nowait(event)
+                except queue.Full:
+                    # A stalled client is cut off; it reconnects and resyncs
+                    self.unsubscribe(subscription)
+
+dispatch_hub = DispatchHub(poll_interval=DISPATCH_POLL_INTERVAL, max_subscribers=DISPATCH_MAX_STREAMS)
+
+def sse_message(event, data, event_id=None):
+    message = f'event: {event}\ndata: {json.dumps(data)}\n'
+    if event_id is not None:
+        message = f'id: {event_id}\n' + message
+    return message + '\n'
+
+# Availability engine
+class BikeSchedule:
+    # Non-cancelled bookings of one bike as half-open [start, end) intervals,
+    # sorted by start. max_ends[i] is the latest end among the first i+1
+    # intervals, so an overlap test is a single bisect.
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.booking_ids = []
+        self.max_ends = []
+
+    def _rebuild_max_ends(self, position):
+        latest = self.max_ends[position - 1] if position > 0 else None
+        del self.max_ends[position:]
+        for end in self.ends[position:]:
+            latest = end if latest is None or end > latest else latest
+            self.max_ends.append(latest)
+
+    def add(self, booking_id, start, end):
+        position = bisect_right(self.starts, start)
+        self.starts.insert(position, start)
+        self.ends.insert(position, end)
+        self.booking_ids.insert(position, booking_id)
+        self._rebuild_max_ends(position)
+
+    def remove(self, booking_id, start):
+        position = bisect_left(self.starts, start)
+        while position < len(self.starts) and self.booking_ids[position] != booking_id:
+            position += 1
+        if position == len(self.starts):
+            return
+        del self.starts[position]
+        del self.ends[position]
+        del self.booking_ids[position]
+        self._rebuild_max_ends(position)
+
+    def overlaps(self, start, end):
+        # Intervals before `position` start before the requested end
+        position = bisect_left(self.starts, end)
+        return position > 0 and self.max_ends[position - 1] > start
+
+class AvailabilityIndex:
+    # Per-worker interval index of bookings. It is kept in sync with commits
+    # made by this process and fully reloaded every `ttl` seconds to pick up
+    # writes from other workers.
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._schedules = {}
+        self._bookings = {}  # booking_id -> (bike_id, start, end)
+        self._fleet = set()
+        self._loaded_at = None
+        self._refreshing = threading.Lock()
+
+    @staticmethod
+    def bookings_query():
+        # Bookings that ended before today cannot conflict with a new booking
+        cutoff = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+        return db.session.query(
+            Booking.id, Booking.bike_id, Booking.start_date, Booking.end_date
+        ).filter(
+            Booking.status != 'cancelled',
+            Booking.end_date > cutoff
+        )
+
+    def refresh(self):
+        # Sorted here, so the database can range-read the current bookings
+        # instead of walking them all in bike order
+        rows = sorted(self.bookings_query(), key=lambda row: (row.bike_id, row.start_date))
+        fleet = {bike_id for (bike_id,) in db.session.query(Bike.id).filter(Bike.is_available == True)}
+
+        schedules = {}
+        bookings = {}
+        for booking_id, bike_id, start, end in rows:
+            schedule = schedules.get(bike_id)
+            if schedule is None:
+                schedule = schedules[bike_id] = BikeSchedule()
+            schedule.starts.append(start)
+            schedule.ends.append(end)
+            schedule.booking_ids.append(booking_id)
+            bookings[booking_id] = (bike_id, start, end)
+        for schedule in schedules.values():
+            schedule._rebuild_max_ends(0)
+
+        with self._lock:
+            self._schedules = schedules
+            self._bookings = bookings
+            self._fleet = fleet
+            self._loaded_at = time.monotonic()
+        logger.info(f"Availability index loaded {len(bookings)} bookings for {len(fleet)} bikes")
+
+    def ensure_fresh(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at <= self.ttl:
+            return
+        # One request per worker reloads; the rest keep using the current
+        # snapshot, and only wait when there is none yet
+        if not self._refreshing.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self.refresh()
+        finally:
+            self._refreshing.release()
+
+    def add_booking(self, booking_id, bike_id, start, end):
+        with self._lock:
+            self.remove_booking(booking_id)
+            schedule = self._schedules.get(bike_id)
+            if schedule is None:
+                schedule = self._schedules[bike_id] = BikeSchedule()
+            schedule.add(booking_id, start, end)
+            self._bookings[booking_id] = (bike_id, start, end)
+
+    def remove_booking(self, booking_id):
+        with self._lock:
+            entry = self._bookings.pop(booking_id, None)
+            if entry is None:
+                return
+            bike_id, start, _ = entry
+            self._schedules[bike_id].remove(booking_id, start)
+
+    def set_bike_available(self, bike_id, available):
+        with self._lock:
+            if available:
+                self._fleet.add(bike_id)
+            else:
+                self._fleet.discard(bike_id)
+
+    def is_available(self, bike_id, start, end):
+        with self._lock:
+            if bike_id not in self._fleet:
+                return False
+            schedule = self._schedules.get(bike_id)
+            return schedule is None or not schedule.overlaps(start, end)
+
+    def available_bikes(self, start, end, bike_ids=None):
+        with self._lock:
+            candidates = self._fleet if bike_ids is None else self._fleet.intersection(bike_ids)
+            free = []
+            for bike_id in candidates:
+                schedule = self._schedules.get(bike_id)
+                if schedule is None or not schedule.overlaps(start, end):
+                    free.append(bike_id)
+            return sorted(free)
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+availability = AvailabilityIndex(ttl=int(os.getenv('AVAILABILITY_INDEX_TTL', '30')))
+
+# Record booking/bike changes at flush time and apply them to the index only
+# once the transaction commits, so rolled back writes never reach it.
+@event.listens_for(Session, 'after_flush')
+def _collect_availability_changes(session, flush_context):
+    changes = session.info.setdefault('availability_changes', [])
+    for obj in session.new.union(session.dirty):
+        if isinstance(obj, Booking):
+            changes.append(('booking', obj.id, obj.bike_id, obj.start_date, obj.end_date, obj.status))
+        elif isinstance(obj, Bike):
+            changes.append(('bike', obj.id, obj.is_available is not False))
+    for obj in session.deleted:
+        if isinstance(obj, Booking):
+            changes.append(('booking', obj.id, obj.bike_id, None, None, 'cancelled'))
+        elif isinstance(obj, Bike):
+            changes.append(('bike', obj.id, False))
+
+@event.listens_for(Session, 'after_commit')
+def _apply_availability_changes(session):
+    changes = session.info.pop('availability_changes', None)
+    if not changes or not availability.loaded:
+        return
+    for change in changes:
+        if change[0] == 'booking':
+            _, booking_id, bike_id, start, end, status = change
+            if status == 'cancelled':
+                availability.remove_booking(booking_id)
+            else:
+                availability.add_booking(booking_id, bike_id, start, end)
+        else:
+            _, bike_id, available = change
+            availability.set_bike_available(bike_id, available)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_availability_changes(session):
+    session.info.pop('availability_changes', None)
+
+# Spatial index
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180  # of latitude
+# Nearest and radius searches never look further than this
+LOCATION_SEARCH_MAX_KM = float(os.getenv('LOCATION_SEARCH_MAX_KM', '50'))
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def valid_coordinates(latitude, longitude):
+    return (latitude is not None and longitude is not None
+            and -90 <= latitude <= 90 and -180 <= longitude <= 180)
+
+class GridIndex:
+    # Points bucketed into fixed cells of `cell_degrees` on each side.
+    # Queries only visit the cells around the query point, growing outwards
+    # ring by ring, so cost depends on local density instead of fleet size.
+    # Buckets are replaced rather than changed in place, so a query can scan
+    # them while another thread moves points.
+    def __init__(self, cell_degrees=0.01, max_radius_km=None):
+        self.cell_degrees = cell_degrees
+        self.columns = int(round(360 / cell_degrees))
+        self.rows = int(math.ceil(180 / cell_degrees)) + 1
+        self.max_radius_km = max_radius_km or LOCATION_SEARCH_MAX_KM
+        self._cells = {}
+        self._points = {}  # id -> (latitude, longitude, cell)
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, point_id):
+        return point_id in self._points
+
+    def _cell(self, latitude, longitude):
+        return (int(math.floor((latitude + 90) / self.cell_degrees)),
+                int(math.floor((longitude + 180) / self.cell_degrees)) % self.columns)
+
+    def insert(self, point_id, latitude, longitude):
+        self.remove(point_id)
+        cell = self._cell(latitude, longitude)
+        bucket = dict(self._cells.get(cell, ()))
+        bucket[point_id] = (latitude, longitude)
+        self._cells[cell] = bucket
+        self._points[point_id] = (latitude, longitude, cell)
+
+    def remove(self, point_id):
+        entry = self._points.pop(point_id, None)
+        if entry is None:
+            return
+        bucket = dict(self._cells[entry[2]])
+        del bucket[point_id]
+        if bucket:
+            self._cells[entry[2]] = bucket
+        else:
+            del self._cells[entry[2]]
+
+    def _ring_width(self, latitude, ring):
+        # Columns to either side that span at least `ring` rows' worth of km
+        # at every latitude the ring reaches; cells narrow towards the poles
+        highest_latitude = min(90.0, abs(latitude) + (ring + 1) * self.cell_degrees)
+        narrowing = math.cos(math.radians(highest_latitude))
+        if ring >= narrowing * self.columns / 2:
+            return self.columns
+        return int(math.ceil(ring / narrowing))
+
+    def _columns(self, column, width):
+        if 2 * width + 1 >= self.columns:
+            return range(self.columns)
+        return [(column + d) % self.columns for d in range(-width, width + 1)]
+
+    def _ring(self, row, column, ring, width, inner_width):
+        # Cells within `ring` rows and `width` columns of (row, column), less
+        # those the previous ring covered
+        if ring == 0:
+            yield row, column
+            return
+        outer = self._columns(column, width)
+        if 2 * inner_width + 1 >= self.columns:
+            added = ()
+        elif 2 * width + 1 >= self.columns:
+            inner = set(self._columns(column, inner_width))
+            added = [c for c in outer if c not in inner]
+        else:
+            added = [(column + d) % self.columns
+                     for d in itertools.chain(range(-width, -inner_width), range(inner_width + 1, width + 1))]
+        for r in range(max(0, row - ring), min(self.rows, row + ring + 1)):
+            for c in (outer if abs(r - row) == ring else added):
+                yield r, c
+
+    def nearest(self, latitude, longitude, k=1, radius_km=None, exclude=None):
+        # [(distance_km, id)] of the k closest points within radius_km,
+        # closest first. The radius is capped at max_radius_km, so a query
+        # far from every point visits a bounded number of cells.
+        if not self._points or k < 1:
+            return []
+        radius_km = min(radius_km or self.max_radius_km, self.max_radius_km)
+        best = []  # max-heap of (-distance, id), at most k long
+        def visit(buckets):
+            for bucket in buckets:
+                for point_id, (lat, lon) in bucket.items():
+                    if exclude and point_id in exclude:
+                        continue
+                    distance = haversine_km(latitude, longitude, lat, lon)
+                    if distance > radius_km:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, point_id))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, point_id))
+        # Everything outside ring r is at least r cells away in latitude, or
+        # as far east-west since the ring is widened to match
+        ring_km = self.cell_degrees * KM_PER_DEGREE
+        row, column = self._cell(latitude, longitude)
+        width = -1
+        for ring in range(int(math.ceil(radius_km / ring_km)) + 1):
+            inner_width, width = width, self._ring_width(latitude, ring)
+            if (2 * ring + 1) * min(2 * width + 1, self.columns) > len(self._cells):
+                # The rings span more cells than hold points (near the poles,
+                # or a sparse index): checking every occupied cell is cheaper
+                best.clear()
+                visit(list(self._cells.values()))
+                break
+            visit(self._cells.get(cell, {}) for cell in self._ring(row, column, ring, width, inner_width))
+            clearance = ring * ring_km
+            if len(best) == k and -best[0][0] <= clearance:
+                break
+            if len(best) == len(self._points):
+                break
+        return sorted((-negative, point_id) for negative, point_id in best)
+
+    def within(self, latitude, longitude, radius_km):
+        # [(distance_km, id)] of every point within radius_km, closest first
+        return self.nearest(latitude, longitude, k=len(self._points), radius_km=radius_km)
+
+class LocationIndex:
+    # Per-worker spatial indexes of available bikes and online drivers. Like
+    # the availability index it follows this process's commits directly and
+    # is reloaded every `ttl` seconds to pick up other workers' writes.
+    def __init__(self, ttl=30, cell_degrees=0.01):
+        self.ttl = ttl
+        self.cell_degrees = cell_degrees
+        self._lock = threading.RLock()
+        self.bikes = GridIndex(cell_degrees)
+        self.drivers = GridIndex(cell_degrees)
+        self._loaded_at = None
+        self._refreshing = threading.Lock()
+
+    def refresh(self):
+        bikes = GridIndex(self.cell_degrees)
+        for bike_id, latitude, longitude in db.session.query(Bike.id, Bike.latitude, Bike.longitude).filter(
+            Bike.is_available == True, Bike.latitude.isnot(None), Bike.longitude.isnot(None)
+        ):
+            bikes.insert(bike_id, latitude, longitude)
+        drivers = GridIndex(self.cell_degrees)
+        for user_id, latitude, longitude in db.session.query(User.id, User.latitude, User.longitude).filter(
+            User.is_driver == True, User.is_online == True,
+            User.latitude.isnot(None), User.longitude.isnot(None)
+        ):
+            drivers.insert(user_id, latitude, longitude)
+        with self._lock:
+            self.bikes = bikes
+            self.drivers = drivers
+            self._loaded_at = time.monotonic()
+        logger.info(f"Location index loaded {len(bikes)} bikes and {len(drivers)} drivers")
+
+    def ensure_fresh(self):
+        # Reloaded by one request at a time, as AvailabilityIndex does
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at <= self.ttl:
+            return
+        if not self._refreshing.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self.refresh()
+        finally:
+            self._refreshing.release()
+
+    def update(self, kind, point_id, latitude, longitude, active):
+        with self._lock:
+            index = self.bikes if kind == 'bike' else self.drivers
+            if active and valid_coordinates(latitude, longitude):
+                index.insert(point_id, latitude, longitude)
+            else:
+                index.remove(point_id)
+
+    def nearest(self, kind, latitude, longitude, k=1, radius_km=None):
+        with self._lock:
+            index = self.bikes if kind == 'bike' else self.drivers
+        # Scanned outside the lock, so commits updating the index never wait
+        return index.nearest(latitude, longitude, k=k, radius_km=radius_km)
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+locations = LocationIndex(
+    ttl=int(os.getenv('LOCATION_INDEX_TTL', '30')),
+    cell_degrees=float(os.getenv('LOCATION_INDEX_CELL_DEGREES', '0.01'))
+)
+
+@event.listens_for(Session, 'after_flush')
+def _collect_location_changes(session, flush_context):
+    changes = session.info.setdefault('location_changes', [])
+    for obj in session.new.union(session.dirty):
+        if isinstance(obj, Bike):
+            changes.append(('bike', obj.id, obj.latitude, obj.longitude, obj.is_available is not False))
+        elif isinstance(obj, User):
+            changes.append(('driver', obj.id, obj.latitude, obj.longitude, bool(obj.is_driver and obj.is_online)))
+    for obj in session.deleted:
+        if isinstance(obj, Bike):
+            changes.append(('bike', obj.id, None, None, False))
+        elif isinstance(obj, User):
+            changes.append(('driver', obj.id, None, None, False))
+
+@event.listens_for(Session, 'after_commit')
+def _apply_location_changes(session):
+    changes = session.info.pop('location_changes', None)
+    if not changes or not locations.loaded:
+        return
+    for change in changes:
+        locations.update(*change)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_location_changes(session):
+    session.info.pop('location_changes', None)
+
+@app.cli.command('spatial-benchmark')
+@click.option('--points', default=100000, help='Points in the index')
+@click.option('--queries', default=1000, help='Nearest and radius queries to time')
+@click.option('--k', default=5, help='Neighbours per nearest query')
+@click.option('--radius-km', default=2.0, help='Radius for the radius queries')
+@click.option('--cell-degrees', default=0.01, help='Grid cell size')
+@click.option('--seed', default=42, help='Random seed for the synthetic points')
+def spatial_benchmark_command(points, queries, k, radius_km, cell_degrees, seed):
+    """Time the grid index against a full scan on synthetic city-sized data."""
+    rng = np.random.default_rng(seed)
+    # A few dense city centres plus sparse points across the region between them
+    centres = rng.uniform([12.0, 72.0], [28.0, 88.0], size=(8, 2))
+    clustered = points * 4 // 5
+    latitudes = np.concatenate([
+        rng.normal(centres[rng.integers(len(centres), size=clustered), 0], 0.08),
+        rng.uniform(12.0, 28.0, points - clustered)
+    ])
+    longitudes = np.concatenate([
+        rng.normal(centres[rng.integers(len(centres), size=clustered), 1], 0.08),
+        rng.uniform(72.0, 88.0, points - clustered)
+    ])
+    probe = rng.integers(points, size=queries)
+    query_points = np.column_stack([
+        latitudes[probe] + rng.normal(0, 0.01, queries),
+        longitudes[probe] + rng.normal(0, 0.01, queries)
+    ])
+    
+    index = GridIndex(cell_degrees)
+    started = time.perf_counter()
+    for point_id, (latitude, longitude) in enumerate(zip(latitudes.tolist(), longitudes.tolist())):
+        index.insert(point_id, latitude, longitude)
+    build_seconds = time.perf_counter() - started
+    
+    def timed(run):
+        durations, results = [], []
+        for latitude, longitude in query_points.tolist():
+            started = time.perf_counter()
+            results.append(run(latitude, longitude))
+            durations.append(time.perf_counter() - started)
+        durations = np.array(durations) * 1000
+        return results, {
+            'p50_ms': round(float(np.percentile(durations, 50)), 4),
+            'p95_ms': round(float(np.percentile(durations, 95)), 4),
+            'p99_ms': round(float(np.percentile(durations, 99)), 4),
+            'queries_per_second': round(queries / (durations.sum() / 1000), 1)
+        }
+    
+    lat_radians, lon_radians = np.radians(latitudes), np.radians(longitudes)
+    def scan_distances(latitude, longitude):
+        lat, lon = math.radians(latitude), math.radians(longitude)
+        a = (np.sin((lat_radians - lat) / 2) ** 2
+             + math.cos(lat) * np.cos(lat_radians) * np.sin((lon_radians - lon) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+    
+    nearest, nearest_stats = timed(lambda lat, lon: index.nearest(lat, lon, k=k))
+    within, within_stats = timed(lambda lat, lon: index.within(lat, lon, radius_km))
+    def scan_nearest(latitude, longitude):
+        distances = scan_distances(latitude, longitude)
+        return [i for i in np.argsort(distances)[:k].tolist() if distances[i] <= index.max_radius_km]
+    scanned, scan_stats = timed(scan_nearest)
+    
+    # The grid must return exactly what the full scan does
+    mismatches = sum(
+        1 for (latitude, longitude), found, expected, in_radius in zip(query_points.tolist(), nearest, scanned, within)
+        if [point_id for _, point_id in found] != expected
+        or len(in_radius) != int((scan_distances(latitude, longitude) <= min(radius_km, index.max_radius_km)).sum())
+    )
+    click.echo(json.dumps({
+        'points': points,
+        'queries': queries,
+        'k': k,
+        'radius_km': radius_km,
+        'cell_degrees': cell_degrees,
+        'build_seconds': round(build_seconds, 3),
+        'nearest': nearest_stats,
+        'within_radius': {**within_stats, 'mean_results': round(sum(map(len, within)) / queries, 1)},
+        'full_scan_nearest': scan_stats,
+        'mismatches': mismatches
+    }, indent=2))
+    if mismatches:
+        sys.exit(1)
+
+@event.listens_for(Session, 'after_flush')
+def _collect_user_changes(session, flush_context):
+    changed = session.info.setdefault('changed_users', set())
+    bump = False
+    for obj in session.dirty:
+        if isinstance(obj, User) and session.is_modified(obj, include_collections=False):
+            changed.add(obj.id)
+            bump = bump or any(get_history(obj, flag).has_changes() for flag in ('is_admin', 'is_driver'))
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changed.add(obj.id)
+            bump = True
+    if bump:
+        CacheVersion.bump('users', session.connection())
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_cached_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.invalidate(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_user_changes(session):
+    session.info.pop('changed_users', None)
+
+@event.listens_for(Session, 'after_flush')
+def _bump_catalog_version(session, flush_context):
+    # Any bike write invalidates the rendered catalog in every worker
+    for obj in session.new.union(session.deleted):
+        if isinstance(obj, Bike):
+            break
+    else:
+        for obj in session.dirty:
+            if isinstance(obj, Bike) and session.is_modified(obj, include_collections=False):
+                break
+        else:
+            return
+    CacheVersion.bump('catalog', session.connection())
+
+# Job queue
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '300'))
+JOB_RETRY_BASE_SECONDS = float(os.getenv('JOB_RETRY_BASE_SECONDS', '10'))
+JOB_RETRY_MAX_SECONDS = float(os.getenv('JOB_RETRY_MAX_SECONDS', '3600'))
+JOB_RETENTION = timedelta(days=int(os.getenv('JOB_RETENTION_DAYS', '7')))
+JOB_ERROR_LENGTH = 4000
+
+job_handlers = {}  # kind -> (function, max_attempts)
+
+def job_handler(kind, max_attempts=5):
+    # Handlers are called with the job's payload as keyword arguments, in an
+    # app context of their own. They may run more than once, so must be
+    # safe to repeat.
+    def register(function):
+        job_handlers[kind] = (function, max_attempts)
+        return function
+    return register
+
+def enqueue_job(kind, payload, key=None, delay=0, connection=None):
+    # Part of the caller's transaction: the job exists only if the change
+    # that needed it commits. A key that is already queued, running or
+    # done (within JOB_RETENTION) is not enqueued again.
+    connection = connection or db.session.connection()
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    now = datetime.utcnow()
+    connection.execute(
+        dialect.insert(Job.__table__).values(
+            kind=kind, payload=payload, idempotency_key=key, status='queued', attempts=0,
+            max_attempts=job_handlers[kind][1], run_at=now + timedelta(seconds=delay), created_at=now
+        ).on_conflict_do_nothing(index_elements=['idempotency_key'])
+    )
+
+def claim_jobs(worker_id, limit):
+    # Claim up to `limit` due jobs in one statement. Jobs left running by a
+    # worker that died are due again once their lease runs out. SKIP LOCKED
+    # keeps concurrent workers on Postgres from claiming the same rows.
+    table = Job.__table__
+    now = datetime.utcnow()
+    due = db.or_(
+        db.and_(table.c.status == 'queued', table.c.run_at <= now),
+        db.and_(table.c.status == 'running', table.c.locked_at < now - timedelta(seconds=JOB_LEASE_SECONDS))
+    )
+    claimable = db.select(table.c.id).where(due).order_by(table.c.run_at, table.c.id).limit(limit).with_for_update(
+        skip_locked=True)
+    jobs = db.session.execute(
+        table.update()
+        .where(table.c.id.in_(claimable), due)
+        .values(status='running', locked_by=worker_id, locked_at=now, attempts=table.c.attempts + 1)
+        .returning(table.c.id, table.c.kind, table.c.payload, table.c.attempts, table.c.max_attempts)
+    ).all()
+    db.session.commit()
+    return jobs
+
+def job_retry_delay(attempts):
+    # Exponential backoff with jitter, so failures of a shared dependency
+    # do not come back as one burst
+    delay = min(JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1), JOB_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+def run_job(worker_id, job):
+    # Runs one claimed job and records the outcome, unless the lease was
+    # lost to another worker in the meantime
+    table = Job.__table__
+    with app.app_context():
+        try:
+            if job.kind not in job_handlers:
+                raise LookupError(f'No handler for job kind {job.kind}')
+            if job.attempts > job.max_attempts:
+                raise RuntimeError('Gave up after its worker stopped mid-run')
+            job_handlers[job.kind][0](**job.payload)
+            values = {'status': 'done', 'finished_at': datetime.utcnow(), 'last_error': None}
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Job {job.id} ({job.kind}) failed on attempt {job.attempts}: {str(e)}")
+            error = traceback.format_exc()[-JOB_ERROR_LENGTH:]
+            if job.attempts >= job.max_attempts:
+                values = {'status': 'failed', 'finished_at': datetime.utcnow(), 'last_error': error}
+            else:
+                retry_at = datetime.utcnow() + timedelta(seconds=job_retry_delay(job.attempts))
+                values = {'status': 'queued', 'run_at': retry_at, 'last_error': error}
+        try:
+            db.session.execute(
+                table.update()
+                .where(table.c.id == job.id, table.c.status == 'running', table.c.locked_by == worker_id)
+                .values(locked_by=None, locked_at=None, **values)
+            )
+            db.session.commit()
+        finally:
+            db.session.remove()
+    return values['status']
+
+def prune_jobs():
+    # Finished jobs are kept a while for idempotency and inspection; failed
+    # ones stay until someone looks at them
+    table = Job.__table__
+    result = db.session.execute(table.delete().where(
+        table.c.status == 'done', table.c.finished_at < datetime.utcnow() - JOB_RETENTION))
+    db.session.commit()
+    return result.rowcount
+
+class JobWorker:
+    # Claims due jobs in batches and runs them on a thread pool. It claims
+    # no more than there are idle threads, so no claimed job waits in this
+    # process while its lease runs out.
+    def __init__(self, threads=4, batch_size=None, poll_interval=1.0):
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.threads = threads
+        self.batch_size = batch_size or threads
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+        self.counts = {'done': 0, 'queued': 0, 'failed': 0}
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def run(self, once=False):
+        # With once=True, stop when nothing is due and nothing is running
+        pending = set()
+        next_prune = 0.0
+        next_sweep = 0.0
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='jobs') as executor:
+            while not self.stopping.is_set():
+                for future in [future for future in pending if future.done()]:
+                    pending.discard(future)
+                    try:
+                        self.counts[future.result()] += 1
+                    except Exception as e:
+                        logger.error(f"Job worker could not record a result: {str(e)}")
+                jobs = []
+                free = self.threads - len(pending)
+                if free:
+                    with app.app_context():
+                        try:
+                            if MAINTENANCE_SWEEP_SECONDS and time.monotonic() >= next_sweep:
+                                queue_maintenance_sweep()
+                                next_sweep = time.monotonic() + MAINTENANCE_SWEEP_SECONDS
+                            jobs = claim_jobs(self.worker_id, min(free, self.batch_size))
+                            if time.monotonic() >= next_prune:
+                                prune_jobs()
+                                next_prune = time.monotonic() + 3600
+                        except Exception as e:
+                            db.session.rollback()
+                            logger.error(f"Job worker could not claim jobs: {str(e)}")
+                        finally:
+                            db.session.remove()
+                pending.update(executor.submit(run_job, self.worker_id, job) for job in jobs)
+                if once and not jobs and not pending:
+                    break
+                if jobs and len(pending) < self.threads:
+                    continue
+                if pending:
+                    wait(pending, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    self.stopping.wait(self.poll_interval)
+        return self.counts
+
+@app.cli.command('jobs-worker')
+@click.option('--threads', default=4, help='Jobs run at the same time')
+@click.option('--batch-size', default=None, type=int, help='Most jobs claimed per query (default: --threads)')
+@click.option('--poll-interval', default=1.0, help='Seconds between checks when the queue is empty')
+@click.option('--once', is_flag=True, help='Exit once no job is due instead of waiting for more')
+def jobs_worker_command(threads, batch_size, poll_interval, once):
+    """Run queued background jobs until stopped."""
+    worker = JobWorker(threads, batch_size, poll_interval)
+    # Finish the running jobs on SIGTERM; anything claimed but not started is
+    # picked up again once its lease runs out
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    logger.info(f"Job worker {worker.worker_id} started with {threads} threads")
+    counts = worker.run(once=once)
+    click.echo(json.dumps(counts, indent=2))
+
+# Booking side effects, queued by the requests that cause them
+@job_handler('loyalty_accrual')
+def accrue_loyalty(user_id):
+    # Prices the member's newly completed rides, clears the points of rides
+    # that are no longer completed and re-sums the balance and tier from
+    # what is left, so a rerun changes nothing
+    ride = Ride.__table__
+    rate = loyalty_points_rate()
+    with db.engine.begin() as connection:
+        connection.execute(ride.update().where(
+            ride.c.user_id == user_id, ride.c.status == 'completed', ride.c.loyalty_points_earned.is_(None)
+        ).values(loyalty_points_earned=db.cast(ride.c.total_price * rate / 100, db.Integer)))
+        connection.execute(ride.update().where(
+            ride.c.user_id == user_id, ride.c.status != 'completed', ride.c.loyalty_points_earned.isnot(None)
+        ).values(loyalty_points_earned=None))
+        recompute_user_loyalty(connection, user_id, user_id + 1, loyalty_tier_table.tiers())
+
+@job_handler('refund')
+def compute_refund(ride_id, cancellation_fee):
+    # The fee percentage is the one in force when the ride was cancelled
+    ride = db.session.get(Ride, ride_id)
+    if ride is None or ride.status != 'cancelled' or ride.refund_amount is not None:
+        return
+    ride.refund_amount = ride.total_price * (1 - cancellation_fee / 100)
+    enqueue_job('receipt', {'number': f'refund-{ride_id}', 'user_id': ride.user_id, 'items': [
+        {'description': 'Ride total', 'amount': ride.total_price},
+        {'description': f'Cancellation fee ({cancellation_fee:g}%)', 'amount': ride.refund_amount - ride.total_price},
+    ]}, key=f'receipt:refund-{ride_id}')
+    db.session.commit()
+    logger.info(f"Refund of {ride.refund_amount:.2f} computed for ride {ride_id}")
+
+@job_handler('receipt')
+def write_receipt(number, user_id, items):
+    # The number is unique, so a repeated job leaves the first receipt alone
+    table = Receipt.__table__
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    db.session.execute(dialect.insert(table).values(
+        number=number, user_id=user_id, amount=round(sum(item['amount'] for item in items), 2),
+        items=items, created_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=['number']))
+    db.session.commit()
+
+def queue_booking_receipt(booking, quote):
+    # Itemised from the quote the booking was priced with
+    lines = [('Bike rental', 'base_price'), ('Insurance', 'insurance_price'),
+             ('Accessories', 'accessories_price'), ('Rider training', 'training_price')]
+    items = [{'description': description, 'amount': float(quote[key][0, 0])}
+             for description, key in lines if quote[key][0, 0]]
+    if quote['discount'][0, 0]:
+        items.append({'description': 'Loyalty discount', 'amount': -float(quote['discount'][0, 0])})
+    enqueue_job('receipt', {'number': f'booking-{booking.id}', 'user_id': booking.user_id, 'items': items},
+                key=f'receipt:booking-{booking.id}')
+
+# Image pipeline
+BIKE_IMAGE_DIR = 'images/bikes'
+ALLOWED_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp'}
+IMAGE_VARIANTS = {'thumb': 320, 'card': 640, 'detail': 1280}  # widths in pixels
+# Modern format first; browsers without WebP fall back to the JPEG
+IMAGE_FORMATS = [
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+]
+
+def static_file(relative_path):
+    # Older uploads were stored with a leading 'static/'
+    if relative_path.startswith('static/'):
+        relative_path = relative_path[len('static/'):]
+    return relative_path, os.path.join(app.static_folder, relative_path)
+
+def save_bike_upload(upload):
+    # Store the original under its content hash, so re-uploads are free and
+    # every derived file name changes whenever the picture does
+    extension = secure_filename(upload.filename).rsplit('.', 1)[-1].lower()
+    if extension not in ALLOWED_IMAGE_EXTENSIONS:
+        raise ValueError('Unsupported image type')
+    data = upload.read()
+    digest = hashlib.sha256(data).hexdigest()[:20]
+    relative_path, path = static_file(f'{BIKE_IMAGE_DIR}/{digest}.{extension}')
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+    return relative_path
+
+def build_image_variants(relative_path):
+    # Writes every size in every format next to the original and returns
+    # {variant: {'width', 'height', <extension>: path}} with static-relative paths
+    relative_path, path = static_file(relative_path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:20]
+    variants = {}
+    with Image.open(path) as source:
+        # Let JPEG decoding downscale on the fly; enough pixels for the largest size
+        largest = max(IMAGE_VARIANTS.values())
+        source.draft('RGB', (largest, largest))
+        source = ImageOps.exif_transpose(source).convert('RGB')
+        for variant, width in IMAGE_VARIANTS.items():
+            # Never upscale: small originals are only re-encoded
+            resized = source
+            if source.width > width:
+                resized = source.resize((width, round(source.height * width / source.width)), Image.LANCZOS)
+            entry = {'width': resized.width, 'height': resized.height}
+            for extension, image_format, options in IMAGE_FORMATS:
+                variant_path = f'{BIKE_IMAGE_DIR}/{digest}-{variant}.{extension}'
+                target = static_file(variant_path)[1]
+                if not os.path.exists(target):
+                    resized.save(target + '.tmp', image_format, **options)
+                    os.replace(target + '.tmp', target)
+                entry[extension] = variant_path
+            variants[variant] = entry
+    return variants
+
+def image_files(image, variants):
+    paths = {image} if image else set()
+    for entry in (variants or {}).values():
+        paths.update(entry[extension] for extension, _, _ in IMAGE_FORMATS if extension in entry)
+    return paths
+
+def remove_image_files(paths):
+    # Files are named by content, so keep any another bike still points at
+    in_use = set()
+    for image, variants in db.session.query(Bike.image, Bike.image_variants):
+        in_use.update(image_files(image, variants))
+    for relative_path in paths - in_use:
+        try:
+            os.remove(static_file(relative_path)[1])
+        except FileNotFoundError:
+            pass
+
+@job_handler('bike_images')
+def process_bike_image(bike_id, image):
+    # Runs on a job worker, after the upload request has returned
+    variants = build_image_variants(image)
+    bike = db.session.get(Bike, bike_id)
+    if bike is None or bike.image != image:
+        # Deleted or replaced while we were resizing
+        remove_image_files(image_files(image, variants))
+        return
+    bike.image_variants = variants
+    db.session.commit()
+    logger.info(f"Built image variants for bike {bike_id}")
+
+@job_handler('remove_bike_images')
+def remove_bike_images(paths):
+    remove_image_files(set(paths))
+
+def queue_bike_image(bike_id, image):
+    # Call before committing the bike, so the job commits with it
+    if Image is None:
+        logger.warning("Pillow is not installed; serving the original bike image")
+        return
+    enqueue_job('bike_images', {'bike_id': bike_id, 'image': image}, key=f'bike_images:{bike_id}:{image}')
+
+@app.template_global()
+def bike_image_url(bike, variant='card', extension='jpg'):
+    entry = (bike.image_variants or {}).get(variant)
+    if entry and extension in entry:
+        return url_for('static', filename=entry[extension])
+    return url_for('static', filename=static_file(bike.image)[0])
+
+@app.template_global()
+def bike_image_srcset(bike, extension='jpg'):
+    # "url 320w, url 640w, ..." over every size, or '' before processing ran
+    entries = sorted((bike.image_variants or {}).values(), key=lambda entry: entry['width'])
+    return ', '.join(
+        f"{url_for('static', filename=entry[extension])} {entry['width']}w"
+        for entry in entries if extension in entry
+    )
+
+@app.cli.command('build-images')
+@click.option('--force', is_flag=True, help='Rebuild bikes that already have variants')
+def build_images_command(force):
+    """Generate resized image variants for existing bikes."""
+    if Image is None:
+        raise click.ClickException('Pillow is not installed')
+    built = 0
+    for bike in Bike.query.order_by(Bike.id):
+        if bike.image_variants and not force:
+            continue
+        if not os.path.exists(static_file(bike.image)[1]):
+            click.echo(f'Bike {bike.id}: missing {bike.image}')
+            continue
+        bike.image_variants = build_image_variants(bike.image)
+        db.session.commit()
+        built += 1
+    click.echo(f'Built image variants for {built} bikes')
+
+# Static assets
+STATIC_DIST_DIR = 'dist'
+STATIC_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.xml', '.html', '.map', '.ico'}
+CSS_URL_PATTERN = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+# Uploads named by save_bike_upload()/build_image_variants() never change content
+CONTENT_HASHED_UPLOAD = re.compile(r'^' + re.escape(BIKE_IMAGE_DIR) + r'/[0-9a-f]{20}(-[a-z]+)?\.\w+$')
+
+def write_file_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+class StaticAssets:
+    # Copies every static file to static/dist under a name carrying a hash
+    # of its content, with .br/.gz siblings for text formats. The manifest
+    # maps original paths to those copies for url_for().
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, STATIC_DIST_DIR, 'manifest.json')
+        self.files = {}
+        self.encodings = {}
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        self.files = manifest.get('files', {})
+        self.encodings = manifest.get('encodings', {})
+
+    def _sources(self):
+        for directory, dirnames, filenames in os.walk(self.root):
+            relative_dir = os.path.relpath(directory, self.root).replace(os.sep, '/')
+            if relative_dir == '.':
+                dirnames[:] = [name for name in dirnames if name != STATIC_DIST_DIR]
+            for filename in filenames:
+                source = filename if relative_dir == '.' else f'{relative_dir}/{filename}'
+                if not filename.startswith('.') and not filename.endswith('.tmp') \
+                        and not CONTENT_HASHED_UPLOAD.match(source):
+                    yield source
+
+    def _rewrite_css(self, source, data, files):
+        # Point url(...) references at their fingerprinted copies
+        base = os.path.dirname(source)
+        def replace(match):
+            quote, reference = match.groups()
+            if ':' in reference or reference.startswith(('/', '#')):
+                return match.group(0)
+            path, _, suffix = reference.partition('?')
+            target = files.get(os.path.normpath(os.path.join(base, path)).replace(os.sep, '/'))
+            if target is None:
+                return match.group(0)
+            relative = os.path.relpath(target, os.path.dirname(files[source])).replace(os.sep, '/')
+            return f'url({quote}{relative}{"?" + suffix if suffix else ""}{quote})'
+        return CSS_URL_PATTERN.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+    def build(self):
+        files, encodings = {}, {}
+        stats = {'files': 0, 'written': 0, 'gzip': 0, 'brotli': 0}
+        # Stylesheets last, so their url()s can point at already hashed files
+        for source in sorted(self._sources(), key=lambda source: (source.endswith('.css'), source)):
+            with open(os.path.join(self.root, source), 'rb') as f:
+                data = f.read()
+            stem, extension = os.path.splitext(source)
+            if extension == '.css':
+                # The final name depends on the rewritten content; resolve
+                # references from where the copy will live (same directory)
+                files[source] = f'{STATIC_DIST_DIR}/{source}'
+                data = self._rewrite_css(source, data, files)
+            target = f'{STATIC_DIST_DIR}/{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+            files[source] = target
+            stats['files'] += 1
+            path = os.path.join(self.root, target)
+            if not os.path.exists(path):
+                write_file_atomic(path, data)
+                stats['written'] += 1
+            if extension.lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            available = []
+            compressors = [('br', '.br', lambda data: brotli.compress(data, quality=11))] if brotli else []
+            compressors.append(('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0)))
+            for encoding, suffix, compress in compressors:
+                if not os.path.exists(path + suffix):
+                    compressed = compress(data)
+                    # Tiny files can grow when compressed; serve those as is
+                    if len(compressed) >= len(data):
+                        continue
+                    write_file_atomic(path + suffix, compressed)
+                    stats['brotli' if encoding == 'br' else 'gzip'] += 1
+                available.append(encoding)
+            if available:
+                encodings[target] = available
+        write_file_atomic(self.manifest_path, json.dumps(
+            {'files': files, 'encodings': encodings}, indent=2, sort_keys=True
+        ).encode('utf-8'))
+        self.files, self.encodings = files, encodings
+        return stats
+
+    def prune(self):
+        # Drop fingerprinted copies the current manifest no longer uses
+        keep = {os.path.join(self.root, target) for target in self.files.values()}
+        keep.update(path + suffix for path in list(keep) for suffix in ('.br', '.gz'))
+        keep.add(self.manifest_path)
+        removed = 0
+        for directory, _, filenames in os.walk(os.path.join(self.root, STATIC_DIST_DIR)):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if path not in keep:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+static_assets = StaticAssets(app.static_folder)
+static_assets.load()
+if os.getenv('STATIC_BUILD_ON_STARTUP', 'true').lower() == 'true':
+    try:
+        static_assets.build()
+    except OSError as e:
+        # A read-only deploy can still ship a prebuilt manifest
+        logger.warning(f"Static asset build skipped: {str(e)}")
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.files.get(values['filename'], values['filename'])
+
+def serve_static(filename):
+    # Fingerprinted copies and content-named uploads can be cached forever;
+    # everything else goes through Flask's usual revalidating handler
+    if not (filename.startswith(STATIC_DIST_DIR + '/') or CONTENT_HASHED_UPLOAD.match(filename)):
+        return app.send_static_file(filename)
+    response = None
+    for encoding in static_assets.encodings.get(filename, ()):
+        if request.accept_encodings[encoding]:
+            suffix = '.br' if encoding == 'br' else '.gz'
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_from_directory(app.static_folder, filename + suffix,
+                                           mimetype=mimetype, max_age=STATIC_MAX_AGE)
+            response.content_encoding = encoding
+            break
+    if response is None:
+        response = send_from_directory(app.static_folder, filename, max_age=STATIC_MAX_AGE)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = serve_static
+
+@app.cli.command('build-static')
+@click.option('--prune', is_flag=True, help='Delete fingerprinted files the new manifest no longer uses')
+def build_static_command(prune):
+    """Fingerprint and precompress static files into static/dist."""
+    stats = static_assets.build()
+    if prune:
+        stats['pruned'] = static_assets.prune()
+    stats['brotli_available'] = brotli is not None
+    click.echo(json.dumps(stats, indent=2))
+
+# Dashboard metrics
+def upsert_daily_metrics(connection, rows, increment=True):
+    # rows: {day: {column: value}}. Increments existing counters by default;
+    # with increment=False the given columns are overwritten instead.
+    if not rows:
+        return
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    columns = ('bookings', 'completed_revenue', 'new_users', 'maintenance_bikes')
+    # One executemany per set of columns touched, rather than one per day
+    batches = {}
+    for day, values in rows.items():
+        batches.setdefault(tuple(sorted(values)), []).append(
+            {'day': day, **{column: values.get(column, 0) for column in columns}})
+    table = DailyMetrics.__table__.c
+    for touched, params in batches.items():
+        stmt = dialect.insert(DailyMetrics.__table__)
+        if increment:
+            updates = {column: table[column] + stmt.excluded[column] for column in touched}
+        else:
+            updates = {column: stmt.excluded[column] for column in touched}
+        connection.execute(stmt.on_conflict_do_update(index_elements=['day'], set_=updates), params)
+
+def _add_metric(rows, day, column, amount):
+    if day is None or not amount:
+        return
+    if isinstance(day, datetime):
+        day = day.date()
+    counters = rows.setdefault(day, {})
+    counters[column] = counters.get(column, 0) + amount
+
+@event.listens_for(Session, 'after_flush')
+def _record_daily_metrics(session, flush_context):
+    rows = {}
+    maintenance_changed = False
+    for obj in session.new:
+        if isinstance(obj, Ride):
+            _add_metric(rows, obj.pickup_date, 'bookings', 1)
+            if obj.status == 'completed':
+                _add_metric(rows, obj.pickup_date, 'completed_revenue', obj.total_price)
+        elif isinstance(obj, User):
+            _add_metric(rows, obj.created_at or datetime.utcnow(), 'new_users', 1)
+        elif isinstance(obj, Bike):
+            maintenance_changed = maintenance_changed or obj.in_maintenance is True
+    for obj in session.dirty:
+        if isinstance(obj, Ride):
+            status = get_history(obj, 'status')
+            if not status.has_changes():
+                continue
+            old_status = status.deleted[0] if status.deleted else None
+            if old_status == 'completed' and obj.status != 'completed':
+                old_price = get_history(obj, 'total_price')
+                old_pickup = get_history(obj, 'pickup_date')
+                price = old_price.deleted[0] if old_price.deleted else obj.total_price
+                pickup = old_pickup.deleted[0] if old_pickup.deleted else obj.pickup_date
+                _add_metric(rows, pickup, 'completed_revenue', -price)
+            elif obj.status == 'completed' and old_status != 'completed':
+                _add_metric(rows, obj.pickup_date, 'completed_revenue', obj.total_price)
+        elif isinstance(obj, Bike):
+            maintenance_changed = maintenance_changed or get_history(obj, 'in_maintenance').has_changes()
+    for obj in session.deleted:
+        if isinstance(obj, Ride):
+            _add_metric(rows, obj.pickup_date, 'bookings', -1)
+            if obj.status == 'completed':
+                _add_metric(rows, obj.pickup_date, 'completed_revenue', -obj.total_price)
+        elif isinstance(obj, User):
+            _add_metric(rows, obj.created_at, 'new_users', -1)
+        elif isinstance(obj, Bike):
+            maintenance_changed = maintenance_changed or obj.in_maintenance is True
+
+    connection = session.connection()
+    upsert_daily_metrics(connection, rows)
+    if maintenance_changed:
+        record_maintenance_snapshot(connection)
+
+def record_maintenance_snapshot(connection):
+    # Maintenance is a snapshot rather than a counter: store today's count
+    count = connection.execute(
+        db.select(db.func.count()).select_from(Bike).where(Bike.in_maintenance.is_(True))
+    ).scalar()
+    upsert_daily_metrics(connection, {datetime.utcnow().date(): {'maintenance_bikes': count}}, increment=False)
+
+def subtract_ride_metrics(connection, *criteria):
+    # Takes rides that are about to be bulk deleted out of the rollups; a
+    # bulk DELETE never reaches the flush hook
+    ride_day = db.func.date(Ride.pickup_date)
+    rows = {}
+    for day, bookings, revenue in connection.execute(db.select(
+        ride_day,
+        db.func.count(Ride.id),
+        db.func.coalesce(db.func.sum(db.case((Ride.status == 'completed', Ride.total_price), else_=0)), 0)
+    ).where(*criteria).group_by(ride_day)):
+        _add_metric(rows, _as_date(day), 'bookings', -bookings)
+        _add_metric(rows, _as_date(day), 'completed_revenue', -revenue)
+    upsert_daily_metrics(connection, rows)
+
+def backfill_daily_metrics(since=None):
+    # Recompute the counters from the ride and user tables with two grouped
+    # queries. Maintenance snapshots cannot be reconstructed and are kept.
+    ride_day = db.func.date(Ride.pickup_date)
+    ride_query = db.session.query(
+        ride_day,
+        db.func.count(Ride.id),
+        db.func.coalesce(db.func.sum(db.case((Ride.status == 'completed', Ride.total_price), else_=0)), 0)
+    ).group_by(ride_day)
+    user_day = db.func.date(User.created_at)
+    user_query = db.session.query(user_day, db.func.count(User.id)).filter(User.created_at.isnot(None)).group_by(user_day)
+    if since:
+        ride_query = ride_query.filter(Ride.pickup_date >= since)
+        user_query = user_query.filter(User.created_at >= since)
+
+    rows = {}
+    for day, bookings, revenue in ride_query:
+        rows.setdefault(_as_date(day), {}).update(bookings=bookings, completed_revenue=revenue)
+    for day, new_users in user_query:
+        rows.setdefault(_as_date(day), {})['new_users'] = new_users
+
+    # Days with no activity left are reset rather than left stale
+    stale = DailyMetrics.query.with_entities(DailyMetrics.day)
+    if since:
+        stale = stale.filter(DailyMetrics.day >= since.date())
+    for (day,) in stale:
+        rows.setdefault(day, {})
+    for values in rows.values():
+        for column in ('bookings', 'completed_revenue', 'new_users'):
+            values.setdefault(column, 0)
+
+    upsert_daily_metrics(db.session.connection(), rows, increment=False)
+    db.session.commit()
+    return len(rows)
+
+def _as_date(value):
+    # SQLite returns date() results as ISO strings
+    if isinstance(value, str):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+@app.cli.command('metrics-backfill')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='Only rebuild days from this date on')
+def metrics_backfill_command(since):
+    """Rebuild the daily dashboard rollups from ride and user history."""
+    days = backfill_daily_metrics(since)
+    click.echo(f'Rebuilt metrics for {days} days')
+
+# Maintenance scheduler
+# A bike falls due for service on its next_service_date, or as soon as the
+# kms ridden since its last service reach its service_interval. That moment
+# is kept in bike.service_due_at and updated as rides complete, so the
+# index on it is the fleet's due queue: the sweep and the due-soon listing
+# read its head instead of every bike and every ride.
+MAINTENANCE_SERVICE_DAYS = int(os.getenv('MAINTENANCE_SERVICE_DAYS', '90'))
+# How often job workers queue a sweep; 0 leaves it to `flask maintenance-sweep`
+MAINTENANCE_SWEEP_SECONDS = int(os.getenv('MAINTENANCE_SWEEP_SECONDS', '300'))
+MAINTENANCE_DUE_SOON_DAYS = 14
+
+def service_due_date(bike, now):
+    # Python twin of service_due_case(), for bikes written through the ORM
+    interval = bike.service_interval
+    if interval and interval > 0 and (bike.kms_since_service or 0) >= interval:
+        return min(bike.next_service_date, now) if bike.next_service_date else now
+    return bike.next_service_date
 
-class Booking(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    bike_id = db.Column(db.Integer, db.ForeignKey('bike.id'), nullable=False)
-    start_date = db.Column(db.DateTime, nullable=False)
-    end_date = db.Column(db.DateTime, nullable=False)
-    total_price = db.Column(db.Float, nullable=False)
-    status = db.Column(db.String(20), default='pending')  # pending, confirmed, cancelled, completed
-    payment_status = db.Column(db.String(20), default='pending')
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    
-    # Relationships
-    user = db.relationship('User', backref='bookings')
-    bike = db.relationship('Bike', backref='bookings')
+def service_due_case(table, kms, now, overdue_since=None):
+    # When a bike with `kms` ridden since its last service falls due.
+    # `overdue_since` keeps the time a bike already went over its interval.
+    over = db.and_(table.c.service_interval > 0, kms >= table.c.service_interval)
+    reached = db.case((table.c.next_service_date < now, table.c.next_service_date), else_=now)
+    if overdue_since is not None:
+        reached = db.func.coalesce(overdue_since, reached)
+    return db.case((over, reached), else_=table.c.next_service_date)
+
+@event.listens_for(Bike, 'before_insert')
+@event.listens_for(Bike, 'before_update')
+def _schedule_bike_service(mapper, connection, bike):
+    if inspect(bike).pending or any(get_history(bike, name).has_changes()
+                                    for name in ('next_service_date', 'service_interval', 'kms_since_service')):
+        bike.service_due_at = service_due_date(bike, datetime.utcnow())
+
+def add_service_kms(connection, deltas):
+    # deltas: {bike_id: kms}; adds to each bike's count, never below zero,
+    # and brings its due time forward to now if that takes it over the interval
+    deltas = {bike_id: kms for bike_id, kms in deltas.items() if kms}
+    if not deltas:
+        return
+    table = Bike.__table__
+    kms = db.func.coalesce(table.c.kms_since_service, 0) + db.bindparam('kms', type_=db.Integer)
+    kms = db.case((kms < 0, 0), else_=kms)
+    was_over = db.and_(table.c.service_interval > 0,
+                       db.func.coalesce(table.c.kms_since_service, 0) >= table.c.service_interval)
+    connection.execute(
+        table.update().where(table.c.id == db.bindparam('target')).values(
+            kms_since_service=kms,
+            service_due_at=service_due_case(table, kms, datetime.utcnow(),
+                                            db.case((was_over, table.c.service_due_at)))
+        ), [{'target': bike_id, 'kms': value} for bike_id, value in deltas.items()]
+    )
+
+@event.listens_for(Session, 'after_flush')
+def _accumulate_service_kms(session, flush_context):
+    # A ride's kms count towards its bike's next service once the ride is
+    # completed, and are taken back if it stops being completed
+    deltas = {}
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, Ride):
+            continue
+        status = get_history(obj, 'status')
+        old_status = status.deleted[0] if status.deleted else (None if obj in session.new else obj.status)
+        completed = obj.status == 'completed' and obj not in session.deleted
+        if completed and old_status != 'completed':
+            deltas[obj.bike_id] = deltas.get(obj.bike_id, 0) + (obj.estimated_kms or 0)
+        elif old_status == 'completed' and not completed:
+            previous = get_history(obj, 'estimated_kms')
+            kms = (previous.deleted[0] if previous.deleted else obj.estimated_kms) or 0
+            deltas[obj.bike_id] = deltas.get(obj.bike_id, 0) - kms
+    if not any(deltas.values()):
+        return
+    connection = session.connection()
+    add_service_kms(connection, deltas)
+    loaded = [obj for obj in session.identity_map.values() if isinstance(obj, Bike) and obj.id in deltas]
+    if loaded:
+        table = Bike.__table__
+        rows = {row.id: row for row in connection.execute(
+            db.select(table.c.id, table.c.kms_since_service, table.c.service_due_at)
+            .where(table.c.id.in_([obj.id for obj in loaded]))
+        )}
+        for obj in loaded:
+            set_committed_value(obj, 'kms_since_service', rows[obj.id].kms_since_service)
+            set_committed_value(obj, 'service_due_at', rows[obj.id].service_due_at)
+
+def rebuild_service_schedule(connection, only_missing=False):
+    # Recount kms since the last service from the completed rides and
+    # recompute due times, for bikes written around the ORM (seed data) or
+    # added before the scheduler (only_missing). Reads every ride once.
+    bike, ride = Bike.__table__, Ride.__table__
+    targets = db.select(bike.c.id)
+    if only_missing:
+        targets = targets.where(bike.c.kms_since_service.is_(None))
+    bike_ids = connection.execute(targets).scalars().all()
+    if not bike_ids:
+        return 0
+    ridden = connection.execute(
+        db.select(ride.c.bike_id, db.func.sum(ride.c.estimated_kms))
+        .select_from(ride.join(bike, bike.c.id == ride.c.bike_id))
+        .where(ride.c.status == 'completed',
+               db.or_(bike.c.last_service_date.is_(None), ride.c.dropoff_date >= bike.c.last_service_date))
+        .group_by(ride.c.bike_id)
+    ).all()
+    kms = dict.fromkeys(bike_ids, 0)
+    kms.update((bike_id, int(total)) for bike_id, total in ridden if bike_id in kms)
+    connection.execute(
+        bike.update().where(bike.c.id == db.bindparam('target'))
+        .values(kms_since_service=db.bindparam('kms', type_=db.Integer)),
+        [{'target': bike_id, 'kms': value} for bike_id, value in kms.items()]
+    )
+    now = datetime.utcnow()
+    for start in range(0, len(bike_ids), 500):
+        connection.execute(bike.update().where(bike.c.id.in_(bike_ids[start:start + 500])).values(
+            service_due_at=service_due_case(bike, bike.c.kms_since_service, now),
+            in_maintenance=db.func.coalesce(bike.c.in_maintenance, False)))
+    return len(bike_ids)
+
+def pull_due_bikes(now=None):
+    # Takes every due bike that is still bookable out of the fleet with
+    # one UPDATE over the head of the due index. Bookings already made are
+    # left alone; servicing the bike puts it back (record_bike_service()).
+    table = Bike.__table__
+    now = now or datetime.utcnow()
+    connection = db.session.connection()
+    bike_ids = connection.execute(
+        table.update()
+        .where(table.c.service_due_at <= now, table.c.is_available == True)
+        .values(is_available=False, in_maintenance=True)
+        .returning(table.c.id)
+    ).scalars().all()
+    if bike_ids:
+        # Done around the ORM, so do what its hooks would have
+        db.session.info.setdefault('availability_changes', []).extend(
+            ('bike', bike_id, False) for bike_id in bike_ids)
+        CacheVersion.bump('catalog', connection)
+        record_maintenance_snapshot(connection)
+    return bike_ids
+
+@job_handler('maintenance_sweep')
+def maintenance_sweep():
+    bike_ids = pull_due_bikes()
+    db.session.commit()
+    if bike_ids:
+        logger.info(f"Maintenance sweep took {len(bike_ids)} bikes out of the fleet")
+
+def queue_maintenance_sweep():
+    # Every job worker asks; the key lets one sweep per interval through
+    slot = int(time.time() // MAINTENANCE_SWEEP_SECONDS)
+    enqueue_job('maintenance_sweep', {}, key=f'maintenance_sweep:{slot}')
+    db.session.commit()
+
+@app.cli.command('maintenance-sweep')
+@click.option('--rebuild', is_flag=True, help='Recount kms and due times from ride history first')
+def maintenance_sweep_command(rebuild):
+    """Take bikes that are due for service out of the fleet."""
+    counts = {}
+    if rebuild:
+        with db.engine.begin() as connection:
+            counts['rescheduled'] = rebuild_service_schedule(connection)
+    counts['pulled'] = len(pull_due_bikes())
+    db.session.commit()
+    click.echo(json.dumps(counts, indent=2))
 
 # Sample bike data
 sample_bikes = [
@@ -342,6 +2997,14 @@ loyalty_tiers = [
     }
 ]
 
+# Default system settings
+default_settings = [
+    ('min_distance', '100', 'Minimum booking distance in kilometers'),
+    ('security_deposit', '5000', 'Security deposit amount in rupees'),
+    ('points_per_100', '10', 'Loyalty points earned per 100 rupees spent'),
+    ('cancellation_fee', '20', 'Cancellation fee percentage')
+]
+
 # Sample data for accessories
 sample_accessories = [
     {
@@ -378,10 +3041,13 @@ sample_accessories = [
 
 # Routes
 @app.route('/')
+@read_replica
 def index():
-    # Get 3 featured bikes
-    featured_bikes = Bike.query.filter_by(is_available=True).limit(3).all()
-    return render_template('index.html', bikes=featured_bikes)
+    def render():
+        # Get 3 featured bikes
+        featured_bikes = bike_list_query('description').filter_by(is_available=True).limit(3).all()
+        return render_template('index.html', bikes=featured_bikes)
+    return cached_catalog_page('index', render)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -400,10 +3066,15 @@ def register():
             flash('Email already exists')
             return redirect(url_for('register'))
 
+        try:
+            password_hash = password_hasher.hash(password)
+        except PasswordHasherBusy:
+            return hasher_busy_response('register.html')
+
         user = User(
             username=username,
             email=email,
-            password_hash=generate_password_hash(password),
+            password_hash=password_hash,
             phone=phone,
             is_driver=is_driver,
             is_admin=False  # Only set to True manually for admin users
@@ -423,7 +3094,19 @@ def login():
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
 
-        if user and check_password_hash(user.password_hash, password):
+        try:
+            valid = user is not None and password_hasher.verify(user.password_hash, password)
+        except PasswordHasherBusy:
+            return hasher_busy_response('login.html')
+
+        if valid:
+            # Upgrade hashes made with an older cost setting
+            if password_hasher.needs_rehash(user.password_hash):
+                try:
+                    user.password_hash = password_hasher.hash(password)
+                    db.session.commit()
+                except PasswordHasherBusy:
+                    pass
             login_user(user)
             flash('Login successful!')
             return redirect(url_for('index'))
@@ -440,14 +3123,25 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/bikes')
+@read_replica
 def bikes():
-    bikes = Bike.query.filter_by(is_available=True).all()
-    return render_template('bikes.html', bikes=bikes)
+    # Only the first page is rendered; filters and further pages come from /bikes/search
+    def render():
+        filters = parse_search_args({})
+        bikes, next_cursor, facets, total = search_bikes(filters)
+        return render_template('bikes.html', bikes=bikes, next_cursor=next_cursor, facets=facets, total=total,
+                               sorts=list(SEARCH_SORTS))
+    return cached_catalog_page('bikes', render)
 
 @app.route('/bike/<int:bike_id>')
+@read_replica
 def bike_detail(bike_id):
-    bike = Bike.query.get_or_404(bike_id)
-    return render_template('bike_detail.html', bike=bike)
+    def render():
+        bike = Bike.query.options(
+            db.undefer_group('detail'), db.selectinload(Bike.maintenance_history)
+        ).filter_by(id=bike_id).first_or_404()
+        return render_template('bike_detail.html', bike=bike)
+    return cached_catalog_page(('bike', bike_id), render)
 
 @app.route('/book-ride', methods=['POST'])
 @login_required
@@ -461,44 +3155,34 @@ def book_ride():
         if end_date <= start_date:
             return jsonify({'success': False, 'message': 'End date must be after start date'})
         
-        # Check availability again (in case of race conditions)
-        overlapping = Booking.query.filter(
-            Booking.bike_id == data['bike_id'],
-            Booking.status != 'cancelled',
-            Booking.start_date <= end_date,
-            Booking.end_date >= start_date
-        ).first()
-        
-        if overlapping:
+        bike_id = int(data['bike_id'])
+        insurance = data.get('insurance')
+        if not isinstance(insurance, str) or insurance not in INSURANCE_RATES:
+            return jsonify({'success': False, 'message': f'Invalid quote request: Unknown insurance type: {insurance}'}), 400
+
+        # Reject known conflicts cheaply. The index may lag bookings made by
+        # other workers; reserve_bike() below is the authoritative check.
+        availability.ensure_fresh()
+        if not availability.is_available(bike_id, start_date, end_date):
             return jsonify({'success': False, 'message': 'Bike is no longer available for the selected dates'})
         
         # Calculate price
-        bike = Bike.query.get_or_404(data['bike_id'])
+        bike = Bike.query.get_or_404(bike_id)
         duration = (end_date - start_date).days
-        base_price = bike.price * duration
-        
-        # Calculate insurance cost
-        insurance_cost = 500 if data['insurance'] == 'basic' else 1000
-        insurance_cost *= duration
-        
-        # Calculate training cost
-        training_cost = 2000 if data.get('training') else 0
-        
-        # Calculate total price
-        total_price = base_price + insurance_cost + training_cost
-        
-        # Create booking
-        booking = Booking(
-            user_id=current_user.id,
-            bike_id=data['bike_id'],
-            start_date=start_date,
-            end_date=end_date,
-            total_price=total_price,
-            status='pending'
+        quote = quote_prices(
+            [bike.price], [duration],
+            insurance=insurance,
+            training=bool(data.get('training')),
+            discount_percentage=loyalty_discount(current_user)
         )
+        total_price = float(quote['total_price'][0, 0])
         
-        db.session.add(booking)
-        db.session.commit()
+        # Create booking
+        try:
+            booking = reserve_bike(current_user.id, bike_id, start_date, end_date, total_price,
+                                   on_reserved=lambda booking: queue_booking_receipt(booking, quote))
+        except BikeUnavailable:
+            return jsonify({'success': False, 'message': 'Bike is no longer available for the selected dates'})
         
         return jsonify({
             'success': True,
@@ -513,11 +3197,421 @@ def book_ride():
             'message': str(e)
         }), 500
 
+@app.route('/check-availability', methods=['GET', 'POST'])
+def check_availability():
+    data = request.get_json(silent=True) or request.args
+    try:
+        start_date = datetime.strptime(data['start_date'], '%Y-%m-%d')
+        end_date = datetime.strptime(data['end_date'], '%Y-%m-%d')
+        bike_id = int(data['bike_id']) if data.get('bike_id') else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'start_date and end_date (YYYY-MM-DD) are required'}), 400
+    if end_date <= start_date:
+        return jsonify({'success': False, 'message': 'End date must be after start date'}), 400
+    
+    availability.ensure_fresh()
+    if bike_id is not None:
+        return jsonify({
+            'success': True,
+            'bike_id': bike_id,
+            'available': availability.is_available(bike_id, start_date, end_date)
+        })
+    
+    # No bike given: answer for the whole fleet in one call
+    return jsonify({
+        'success': True,
+        'available_bike_ids': availability.available_bikes(start_date, end_date)
+    })
+
+NEAREST_MAX_RESULTS = 50
+
+def parse_point(data, prefix=''):
+    latitude = float(data[f'{prefix}latitude'])
+    longitude = float(data[f'{prefix}longitude'])
+    if not valid_coordinates(latitude, longitude):
+        raise ValueError('Coordinates out of range')
+    return latitude, longitude
+
+def parse_nearest_query(data):
+    k = min(int(data.get('k') or 5), NEAREST_MAX_RESULTS)
+    radius_km = float(data['radius_km']) if data.get('radius_km') else None
+    if k < 1 or (radius_km is not None and radius_km <= 0):
+        raise ValueError('k and radius_km must be positive')
+    return k, radius_km
+
+@app.route('/nearest-bikes')
+def nearest_bikes():
+    try:
+        latitude, longitude = parse_point(request.args)
+        k, radius_km = parse_nearest_query(request.args)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'latitude and longitude are required'}), 400
+    
+    locations.ensure_fresh()
+    matches = locations.nearest('bike', latitude, longitude, k=k, radius_km=radius_km)
+    bikes = {bike.id: bike for bike in Bike.query.filter(Bike.id.in_([bike_id for _, bike_id in matches]))}
+    return jsonify({
+        'success': True,
+        'bikes': [{
+            'bike_id': bike_id,
+            'name': bikes[bike_id].name,
+            'price': bikes[bike_id].price,
+            'distance_km': round(distance, 3)
+        } for distance, bike_id in matches if bike_id in bikes]
+    })
+
+@app.route('/nearest-drivers')
+@login_required
+def nearest_drivers():
+    # Around a ride's pickup point (its rider or an admin) or, for admins,
+    # around any coordinates
+    try:
+        if request.args.get('ride_id'):
+            ride = Ride.query.get_or_404(int(request.args['ride_id']))
+            if ride.user_id != current_user.id and not current_user.is_admin:
+                return jsonify({'success': False, 'message': 'Access denied'}), 403
+            latitude, longitude = parse_point(
+                {'latitude': ride.pickup_latitude, 'longitude': ride.pickup_longitude}
+            )
+        elif current_user.is_admin:
+            latitude, longitude = parse_point(request.args)
+        else:
+            return jsonify({'success': False, 'message': 'Access denied'}), 403
+        k, radius_km = parse_nearest_query(request.args)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'A pickup point with coordinates is required'}), 400
+    
+    locations.ensure_fresh()
+    matches = locations.nearest('driver', latitude, longitude, k=k, radius_km=radius_km)
+    return jsonify({
+        'success': True,
+        'drivers': [{'driver_id': driver_id, 'distance_km': round(distance, 3)} for distance, driver_id in matches]
+    })
+
+@app.route('/driver/location', methods=['POST'])
+@login_required
+def update_driver_location():
+    if not current_user.is_driver:
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    data = request.get_json(silent=True) or request.form
+    online = str(data.get('online', 'true')).lower() in ('1', 'true', 'yes', 'on')
+    try:
+        latitude, longitude = parse_point(data) if online else (current_user.latitude, current_user.longitude)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'latitude and longitude are required to go online'}), 400
+    
+    current_user.latitude = latitude
+    current_user.longitude = longitude
+    current_user.is_online = online
+    db.session.commit()
+    return jsonify({'success': True, 'online': online})
+
+@app.route('/calculate-price', methods=['POST'])
+def calculate_price():
+    # Either a single quote ({bike_id, start_date, end_date}) or a batch
+    # ({bike_ids: [...], ranges: [{start_date, end_date}, ...]}) priced for
+    # every bike and range combination
+    data = request.get_json(silent=True) or {}
+    single = 'bike_id' in data
+    try:
+        bike_ids = [int(data['bike_id'])] if single else [int(bike_id) for bike_id in data['bike_ids']]
+        ranges = data.get('ranges') or [{'start_date': data['start_date'], 'end_date': data['end_date']}]
+        periods = []
+        for date_range in ranges:
+            start_date = datetime.strptime(date_range['start_date'], '%Y-%m-%d')
+            end_date = datetime.strptime(date_range['end_date'], '%Y-%m-%d')
+            if end_date <= start_date:
+                raise ValueError('End date must be after start date')
+            periods.append((date_range['start_date'], date_range['end_date'], (end_date - start_date).days))
+        accessory_ids = [int(accessory_id) for accessory_id in data.get('accessory_ids') or []]
+        insurance = data.get('insurance') or 'basic'
+        if insurance not in INSURANCE_RATES:
+            raise ValueError(f'Unknown insurance type: {insurance}')
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': f'Invalid quote request: {e}'}), 400
+    if not bike_ids or len(bike_ids) * len(periods) > QUOTE_MAX_CELLS:
+        return jsonify({'success': False, 'message': f'Between 1 and {QUOTE_MAX_CELLS} quotes per request'}), 400
+    
+    bike_prices = dict(db.session.query(Bike.id, Bike.price).filter(Bike.id.in_(bike_ids)))
+    missing = [bike_id for bike_id in bike_ids if bike_id not in bike_prices]
+    if missing:
+        return jsonify({'success': False, 'message': f'Unknown bikes: {missing}'}), 404
+    accessories_per_day = 0.0
+    if accessory_ids:
+        accessories_per_day = db.session.query(db.func.sum(Accessory.price_per_day)).filter(
+            Accessory.id.in_(accessory_ids)
+        ).scalar() or 0.0
+    security_deposit = float(Settings.get_value('security_deposit', '5000'))
+    
+    quote = quote_prices(
+        [bike_prices[bike_id] for bike_id in bike_ids],
+        [days for _, _, days in periods],
+        insurance=insurance,
+        training=bool(data.get('training')),
+        accessories_per_day=accessories_per_day,
+        discount_percentage=loyalty_discount(current_user)
+    )
+    columns = {name: values.tolist() for name, values in quote.items()}
+    quotes = []
+    for row, bike_id in enumerate(bike_ids):
+        for column, (start_date, end_date, days) in enumerate(periods):
+            item = {name: values[row][column] for name, values in columns.items()}
+            item.update(bike_id=bike_id, start_date=start_date, end_date=end_date, days=days)
+            quotes.append(item)
+    
+    if single and len(quotes) == 1:
+        return jsonify({'success': True, 'security_deposit': security_deposit, **quotes[0]})
+    return jsonify({'success': True, 'security_deposit': security_deposit, 'quotes': quotes})
+
+# Keyset pagination
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(values):
+    payload = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, columns):
+    # Raises ValueError for anything that is not a cursor we issued
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError, json.JSONDecodeError, base64.binascii.Error) as e:
+        raise ValueError(f'Invalid cursor: {e}')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor')
+    return [datetime.fromisoformat(value) if isinstance(column.type, db.DateTime) else value
+            for column, value in zip(columns, values)]
+
+def keyset_query(query, columns, cursor=None, limit=PAGE_SIZE, descending=False):
+    # Seek past the last row of the previous page instead of using OFFSET,
+    # so every page is one index range read no matter how deep it is.
+    # `columns` must end with a unique column to make the order total.
+    # One row more than the page is read, to tell whether another follows.
+    if cursor:
+        key = db.tuple_(*columns)
+        values = tuple(decode_cursor(cursor, columns))
+        query = query.filter(key < values if descending else key > values)
+    order = [column.desc() if descending else column.asc() for column in columns]
+    return query.order_by(None).order_by(*order).limit(limit + 1)
+
+def keyset_page(query, columns, cursor=None, limit=PAGE_SIZE, descending=False):
+    rows = keyset_query(query, columns, cursor, limit, descending).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], column.key) for column in columns])
+    return rows, next_cursor
+
+def page_limit():
+    try:
+        return max(1, min(int(request.args.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE))
+    except ValueError:
+        return PAGE_SIZE
+
+def rides_for_user(user_id):
+    return Ride.query.filter_by(user_id=user_id).order_by(Ride.pickup_date.desc())
+
+def pending_rides():
+    return Ride.query.filter_by(status='pending').order_by(Ride.pickup_date)
+
+# Catalog search
+SEARCH_MAX_TERMS = 10
+SEARCH_PRICE_BUCKETS = (0, 1000, 5000, 10000, 20000)  # lower bounds
+SEARCH_RATINGS = {'min_safety': 'safety_rating', 'min_comfort': 'comfort_rating',
+                  'min_performance': 'performance_rating'}
+SEARCH_SORTS = {  # name -> (keyset columns, descending)
+    'newest': ((Bike.id,), True),
+    'price_asc': ((Bike.price, Bike.id), False),
+    'price_desc': ((Bike.price, Bike.id), True),
+}
+# On Postgres the text is matched through a GIN index over this expression,
+# which needs no upkeep; SQLite keeps an FTS5 table in step with the bikes
+SEARCH_DOCUMENT = "to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, ''))"
+
+def ensure_search_index(connection):
+    # Returns True when the index had to be created
+    if connection.dialect.name == 'postgresql':
+        if connection.exec_driver_sql("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_bike_search'").first():
+            return False
+        connection.exec_driver_sql(f'CREATE INDEX ix_bike_search ON bike USING gin ({SEARCH_DOCUMENT})')
+        return True
+    if connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'bike_search'").first():
+        return False
+    connection.exec_driver_sql(
+        "CREATE VIRTUAL TABLE bike_search USING fts5(name, description, tokenize='unicode61 remove_diacritics 2')"
+    )
+    rebuild_search_index(connection)
+    return True
+
+def rebuild_search_index(connection):
+    # For bikes written without the ORM (seed-data); the session hook
+    # below covers add_bike() and delete_bike()
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('DELETE FROM bike_search')
+        connection.exec_driver_sql(
+            'INSERT INTO bike_search (rowid, name, description) SELECT id, name, description FROM bike')
+
+@event.listens_for(Session, 'after_flush')
+def _sync_bike_search(session, flush_context):
+    bike_ids = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Bike) and (obj in session.new or obj in session.deleted
+                                      or get_history(obj, 'name').has_changes()
+                                      or get_history(obj, 'description').has_changes()):
+            bike_ids.add(obj.id)
+    if not bike_ids or session.get_bind(Bike).dialect.name != 'sqlite':
+        return
+    # The flushed rows are already visible to this transaction, and deleted
+    # bikes simply are not copied back
+    search = db.table('bike_search', db.column('rowid'), db.column('name'), db.column('description'))
+    connection = session.connection()
+    connection.execute(search.delete().where(search.c.rowid.in_(bike_ids)))
+    connection.execute(search.insert().from_select(
+        ['rowid', 'name', 'description'],
+        db.select(Bike.id, Bike.name, Bike.description).where(Bike.id.in_(bike_ids))
+    ))
+
+def parse_search_args(args):
+    # Raises ValueError for malformed parameters
+    def number(name):
+        return float(args[name]) if args.get(name) not in (None, '') else None
+    filters = {
+        'terms': re.findall(r'\w+', (args.get('q') or '').lower())[:SEARCH_MAX_TERMS],
+        'types': [value for value in (args.getlist('type') if hasattr(args, 'getlist') else []) if value],
+        'min_price': number('min_price'),
+        'max_price': number('max_price'),
+        'premium': None,
+        'ratings': {column: number(name) for name, column in SEARCH_RATINGS.items() if number(name) is not None},
+        'dates': None,
+        'sort': args.get('sort') or 'newest',
+    }
+    if args.get('premium') not in (None, ''):
+        filters['premium'] = args['premium'].lower() in ('1', 'true', 'yes')
+    if filters['sort'] not in SEARCH_SORTS:
+        raise ValueError(f"sort must be one of {', '.join(SEARCH_SORTS)}")
+    if args.get('start_date') or args.get('end_date'):
+        start = datetime.strptime(args.get('start_date', ''), '%Y-%m-%d')
+        end = datetime.strptime(args.get('end_date', ''), '%Y-%m-%d')
+        if end <= start:
+            raise ValueError('end_date must be after start_date')
+        filters['dates'] = (start, end)
+    return filters
+
+def search_conditions(filters, dialect_name, exclude=None):
+    # WHERE clauses for the filters. A facet leaves out its own filter, so
+    # each option counts the bikes that choosing it would give.
+    conditions = [Bike.is_available == True]
+    if filters['terms']:
+        if dialect_name == 'postgresql':
+            query = ' & '.join(f'{term}:*' for term in filters['terms'])
+            conditions.append(db.literal_column(SEARCH_DOCUMENT).op('@@')(db.func.to_tsquery('english', query)))
+        else:
+            match = ' '.join(f'"{term}"*' for term in filters['terms'])
+            conditions.append(Bike.id.in_(
+                db.select(db.literal_column('rowid')).select_from(db.table('bike_search'))
+                .where(db.literal_column('bike_search').op('MATCH')(match))
+            ))
+    if filters['types'] and exclude != 'type':
+        conditions.append(Bike.type.in_(filters['types']))
+    if exclude != 'price':
+        if filters['min_price'] is not None:
+            conditions.append(Bike.price >= filters['min_price'])
+        if filters['max_price'] is not None:
+            conditions.append(Bike.price <= filters['max_price'])
+    if filters['premium'] is not None and exclude != 'premium':
+        conditions.append(Bike.is_premium == filters['premium'] if filters['premium']
+                          else db.or_(Bike.is_premium == False, Bike.is_premium.is_(None)))
+    for column, minimum in filters['ratings'].items():
+        conditions.append(getattr(Bike, column) >= minimum)
+    if filters['dates']:
+        days = list(booking_days(*filters['dates']))
+        conditions.append(~db.exists().where(
+            BookingSlot.bike_id == Bike.id, BookingSlot.day.between(days[0], days[-1])))
+    return conditions
+
+def search_facets(filters, dialect_name):
+    price_bucket = db.case(
+        *[(Bike.price >= lower, lower) for lower in reversed(SEARCH_PRICE_BUCKETS[1:])], else_=SEARCH_PRICE_BUCKETS[0]
+    )
+    counts = {}
+    for name, key in (('type', Bike.type), ('premium', db.func.coalesce(Bike.is_premium, False)),
+                      ('price', price_bucket)):
+        rows = db.session.query(key, db.func.count()).filter(
+            *search_conditions(filters, dialect_name, exclude=name)).group_by(key).all()
+        counts[name] = {value: count for value, count in rows}
+    uppers = dict(zip(SEARCH_PRICE_BUCKETS, SEARCH_PRICE_BUCKETS[1:]))
+    return {
+        'type': [{'value': value, 'count': count}
+                 for value, count in sorted(counts['type'].items(), key=lambda item: (item[0] is None, item[0] or ''))],
+        'premium': [{'value': bool(value), 'count': count} for value, count in sorted(counts['premium'].items())],
+        'price': [{'min': lower, 'max': uppers.get(lower), 'count': counts['price'][lower]}
+                  for lower in SEARCH_PRICE_BUCKETS if counts['price'].get(lower)],
+    }
+
+def search_bikes(filters, cursor=None, limit=PAGE_SIZE):
+    # One page of matching bikes plus facet counts; the total falls out of
+    # the type facet, which is filtered by everything but type
+    dialect_name = db.session.get_bind(Bike).dialect.name
+    columns, descending = SEARCH_SORTS[filters['sort']]
+    query = bike_list_query(*SEARCH_RATINGS.values()).filter(*search_conditions(filters, dialect_name))
+    bikes, next_cursor = keyset_page(query, list(columns), cursor, limit, descending=descending)
+    facets = search_facets(filters, dialect_name)
+    total = sum(facet['count'] for facet in facets['type']
+                if not filters['types'] or facet['value'] in filters['types'])
+    return bikes, next_cursor, facets, total
+
+@app.route('/bikes/search')
+@read_replica
+def bike_search():
+    try:
+        filters = parse_search_args(request.args)
+        bikes, next_cursor, facets, total = search_bikes(filters, request.args.get('cursor'), page_limit())
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    card_macro = get_template_attribute('_bike_cards.html', 'bike_card')
+    return jsonify({
+        'success': True,
+        'total': total,
+        'bikes': [{
+            'id': bike.id, 'name': bike.name, 'type': bike.type, 'price': bike.price,
+            'is_premium': bool(bike.is_premium), 'safety_rating': bike.safety_rating,
+            'comfort_rating': bike.comfort_rating, 'performance_rating': bike.performance_rating,
+            'image': bike_image_url(bike), 'url': url_for('bike_detail', bike_id=bike.id)
+        } for bike in bikes],
+        'html': ''.join(str(card_macro(bike)) for bike in bikes),
+        'facets': facets,
+        'next_cursor': next_cursor
+    })
+
 @app.route('/my-rides')
+@read_replica
 @login_required
 def my_rides():
-    rides = Ride.query.filter_by(user_id=current_user.id).all()
-    return render_template('my_rides.html', rides=rides)
+    try:
+        rides, next_cursor = keyset_page(
+            rides_for_user(current_user.id), [Ride.pickup_date, Ride.id],
+            request.args.get('cursor'), page_limit(), descending=True
+        )
+    except ValueError:
+        return redirect(url_for('my_rides'))
+    return render_template('my_rides.html', rides=rides, next_cursor=next_cursor)
+
+@app.route('/receipts/<number>')
+@read_replica
+@login_required
+def receipt(number):
+    # Receipts appear once the job worker has written them
+    row = Receipt.query.filter_by(number=number).first()
+    if row is None or (row.user_id != current_user.id and not current_user.is_admin):
+        return jsonify({'success': False, 'message': 'Receipt not found'}), 404
+    return jsonify({
+        'success': True,
+        'number': row.number,
+        'amount': row.amount,
+        'items': row.items,
+        'created_at': row.created_at.isoformat()
+    })
 
 @app.route('/driver-rides')
 @login_required
@@ -526,92 +3620,190 @@ def driver_rides():
         flash('Access denied')
         return redirect(url_for('index'))
 
-    rides = Ride.query.filter_by(status='pending').all()
-    return render_template('driver_rides.html', rides=rides)
+    try:
+        rides, next_cursor = keyset_page(
+            pending_rides(), [Ride.pickup_date, Ride.id],
+            request.args.get('cursor'), page_limit()
+        )
+    except ValueError:
+        return redirect(url_for('driver_rides'))
+    return render_template('driver_rides.html', rides=rides, next_cursor=next_cursor)
+
+@app.route('/driver-rides/stream')
+@login_required
+def driver_ride_stream():
+    # Server-Sent Events: a snapshot of pending rides, then 'pending' and
+    # 'claimed' events as they happen. Browsers reconnect on their own and
+    # send Last-Event-ID, which is replayed from the hub's buffer when possible.
+    if not current_user.is_driver:
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    
+    dispatch_hub.start()
+    subscription = dispatch_hub.subscribe()
+    if subscription is None:
+        # EventSource gives up on a 503; the page then polls /driver-rides/updates
+        return jsonify({'success': False, 'message': 'Too many live feeds open'}), 503, {'Retry-After': '30'}
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    backlog = dispatch_hub.replay(last_event_id) if last_event_id is not None else None
+    snapshot = None
+    if backlog is None:
+        rides, _ = keyset_page(pending_rides(), [Ride.pickup_date, Ride.id])
+        snapshot = [dispatch_ride_payload(ride.id, ride.pickup_location, ride.dropoff_location, ride.pickup_date)
+                    for ride in rides]
+    # The stream itself never touches the database, so give the connection back now
+    db.session.remove()
+    
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            if snapshot is not None:
+                yield sse_message('snapshot', {'rides': snapshot})
+            for event in backlog or []:
+                yield sse_message(event['kind'], event, event['id'])
+            deadline = time.monotonic() + DISPATCH_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    event = subscription.get(timeout=15)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield sse_message(event['kind'], event, event['id'])
+        finally:
+            dispatch_hub.unsubscribe(subscription)
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/driver-rides/updates')
+@login_required
+def driver_ride_updates():
+    # Short-poll fallback for drivers without a live stream: the events
+    # after `after`, or a fresh snapshot when they are no longer buffered
+    if not current_user.is_driver:
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    
+    dispatch_hub.start()
+    after = request.args.get('after', type=int)
+    last_id = dispatch_hub.last_id
+    events = dispatch_hub.replay(after) if after is not None and last_id is not None else None
+    if events is not None:
+        return jsonify({'success': True, 'events': events, 'last_id': events[-1]['id'] if events else after})
+    rides, _ = keyset_page(pending_rides(), [Ride.pickup_date, Ride.id])
+    return jsonify({
+        'success': True,
+        'rides': [dispatch_ride_payload(ride.id, ride.pickup_location, ride.dropoff_location, ride.pickup_date)
+                  for ride in rides],
+        'last_id': last_id
+    })
 
-@app.route('/accept-ride/<int:ride_id>')
+@app.route('/accept-ride/<int:ride_id>', methods=['GET', 'POST'])
 @login_required
 def accept_ride(ride_id):
+    wants_json = request.accept_mimetypes.best == 'application/json'
     if not current_user.is_driver:
+        if wants_json:
+            return jsonify({'success': False, 'message': 'Access denied'}), 403
         flash('Access denied')
         return redirect(url_for('index'))
 
-    ride = Ride.query.get(ride_id)
-    if ride and ride.status == 'pending':
-        ride.status = 'accepted'
-        ride.driver_id = current_user.id
-        db.session.commit()
+    accepted = claim_ride(ride_id, current_user.id)
+    if wants_json:
+        return jsonify({'success': accepted, 'ride_id': ride_id,
+                        'message': 'Ride accepted' if accepted else 'Ride not available'})
+    if accepted:
         flash('Ride accepted successfully!')
     else:
         flash('Ride not available')
 
     return redirect(url_for('driver_rides'))
 
+@app.route('/claim-next-ride', methods=['POST'])
+@login_required
+def claim_next():
+    if not current_user.is_driver:
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    ride_id = claim_next_ride(current_user.id)
+    if ride_id is None:
+        return jsonify({'success': False, 'message': 'No pending rides'})
+    return jsonify({'success': True, 'ride_id': ride_id})
+
+def count_select(model, *criteria):
+    return db.select(db.func.count()).select_from(model).where(*criteria)
+
+def dashboard_counts(now):
+    # Filtered counts shown on the admin dashboard
+    return {
+        'active_bookings': count_select(Ride, Ride.status == 'upcoming'),
+        'booked_bikes': count_select(Ride, Ride.status == 'upcoming', Ride.pickup_date <= now, Ride.dropoff_date >= now),
+        'maintenance_bikes': count_select(Bike, Bike.in_maintenance.is_(True))
+    }
+
 @app.route('/admin')
+@read_replica
 @login_required
 def admin_dashboard():
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
-    # Get statistics
-    total_bikes = Bike.query.count()
-    active_bookings = Ride.query.filter(Ride.status == 'upcoming').count()
-    total_users = User.query.count()
-    total_revenue = db.session.query(db.func.sum(Ride.total_price)).filter(Ride.status == 'completed').scalar() or 0
+    now = datetime.utcnow()
+    today = now.date()
+    
+    # Headline numbers in a single round trip
+    counts = dashboard_counts(now)
+    total_bikes, active_bookings, total_users, booked_bikes, maintenance_bikes, total_revenue = db.session.query(
+        count_select(Bike).scalar_subquery(),
+        counts['active_bookings'].scalar_subquery(),
+        count_select(User).scalar_subquery(),
+        counts['booked_bikes'].scalar_subquery(),
+        counts['maintenance_bikes'].scalar_subquery(),
+        db.select(db.func.coalesce(db.func.sum(DailyMetrics.completed_revenue), 0)).scalar_subquery()
+    ).one()
+    
+    # Bike utilization
+    available_bikes = total_bikes - booked_bikes - maintenance_bikes
+    bike_utilization = [available_bikes, booked_bikes, maintenance_bikes]
+    
+    # Chart series come from the daily rollups of the last 6 months
+    months = []
+    year, month = today.year, today.month
+    for _ in range(6):
+        months.insert(0, (year, month))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    first_day = datetime(months[0][0], months[0][1], 1).date()
+    rollups = DailyMetrics.query.filter(DailyMetrics.day >= first_day).all()
     
-    # Get data for charts
     # Last 7 days bookings
+    daily_bookings = {row.day: row.bookings for row in rollups}
     booking_dates = []
     booking_counts = []
     for i in range(6, -1, -1):
-        date = datetime.now() - timedelta(days=i)
-        count = Ride.query.filter(
-            db.func.date(Ride.pickup_date) == date.date()
-        ).count()
+        date = today - timedelta(days=i)
         booking_dates.append(date.strftime('%d %b'))
-        booking_counts.append(count)
+        booking_counts.append(daily_bookings.get(date, 0))
     
-    # Bike utilization
-    total_bikes = Bike.query.count()
-    booked_bikes = Ride.query.filter(
-        Ride.status == 'upcoming',
-        Ride.pickup_date <= datetime.now(),
-        Ride.dropoff_date >= datetime.now()
-    ).count()
-    maintenance_bikes = Bike.query.filter_by(is_available=False).count()
-    available_bikes = total_bikes - booked_bikes - maintenance_bikes
-    bike_utilization = [available_bikes, booked_bikes, maintenance_bikes]
+    # Revenue and user growth (last 6 months)
+    monthly_revenue = dict.fromkeys(months, 0)
+    monthly_users = dict.fromkeys(months, 0)
+    for row in rollups:
+        key = (row.day.year, row.day.month)
+        if key not in monthly_revenue:
+            # Rides picked up after this month roll up into future days
+            continue
+        monthly_revenue[key] += row.completed_revenue
+        monthly_users[key] += row.new_users
+    revenue_months = [datetime(y, m, 1).strftime('%b %Y') for y, m in months]
+    user_months = list(revenue_months)
+    revenue_data = [monthly_revenue[key] for key in months]
+    user_data = [monthly_users[key] for key in months]
     
-    # Revenue data (last 6 months)
-    revenue_months = []
-    revenue_data = []
-    for i in range(5, -1, -1):
-        month = datetime.now() - timedelta(days=30*i)
-        revenue = db.session.query(db.func.sum(Ride.total_price)).filter(
-            Ride.status == 'completed',
-            db.func.month(Ride.pickup_date) == month.month,
-            db.func.year(Ride.pickup_date) == month.year
-        ).scalar() or 0
-        revenue_months.append(month.strftime('%b %Y'))
-        revenue_data.append(revenue)
-    
-    # User growth (last 6 months)
-    user_months = []
-    user_data = []
-    for i in range(5, -1, -1):
-        month = datetime.now() - timedelta(days=30*i)
-        new_users = User.query.filter(
-            db.func.month(User.created_at) == month.month,
-            db.func.year(User.created_at) == month.year
-        ).count()
-        user_months.append(month.strftime('%b %Y'))
-        user_data.append(new_users)
-    
-    # Get all bikes, bookings, and users
-    bikes = Bike.query.all()
-    bookings = Ride.query.order_by(Ride.pickup_date.desc()).all()
-    users = User.query.all()
+    # First page of each table; the rest is fetched from /admin/api/<kind>
+    bikes, bikes_cursor = admin_listing('bikes')
+    bookings, bookings_cursor = admin_listing('bookings')
+    users, users_cursor = admin_listing('users')
+    next_cursors = {'bikes': bikes_cursor, 'bookings': bookings_cursor, 'users': users_cursor}
     
     # Get system settings
     settings = {
@@ -636,8 +3828,120 @@ def admin_dashboard():
                          bikes=bikes,
                          bookings=bookings,
                          users=users,
+                         next_cursors=next_cursors,
                          settings=settings)
 
+def admin_listing_query(kind):
+    # (query, keyset columns, descending) behind each admin table
+    if kind == 'bikes':
+        return bike_list_query(), [Bike.id], False
+    if kind == 'bookings':
+        query = Ride.query.options(
+            db.joinedload(Ride.user).load_only(User.username),
+            db.joinedload(Ride.bike).load_only(Bike.name)
+        )
+        return query, [Ride.pickup_date, Ride.id], True
+    if kind == 'users':
+        query = User.query.options(db.joinedload(User.loyalty).joinedload(UserLoyalty.tier))
+        return query, [User.id], False
+    raise KeyError(kind)
+
+def admin_listing(kind, cursor=None, limit=PAGE_SIZE):
+    query, columns, descending = admin_listing_query(kind)
+    return keyset_page(query, columns, cursor, limit, descending=descending)
+
+ADMIN_ROW_MACROS = {'bikes': 'bike_row', 'bookings': 'booking_row', 'users': 'user_row'}
+
+def listing_item(kind, row):
+    if kind == 'bikes':
+        return {'id': row.id, 'name': row.name, 'type': row.type, 'price': row.price,
+                'image': row.image, 'is_available': row.is_available}
+    if kind == 'bookings':
+        return {'id': row.id, 'user': row.user.username, 'bike': row.bike.name,
+                'pickup_date': row.pickup_date.isoformat(), 'estimated_kms': row.estimated_kms,
+                'total_price': row.total_price, 'status': row.status}
+    return {'id': row.id, 'username': row.username, 'email': row.email, 'phone': row.phone,
+            'loyalty_tier': row.loyalty.tier.name if row.loyalty and row.loyalty.tier else None,
+            'is_driver': row.is_driver, 'is_admin': row.is_admin}
+
+@app.route('/admin/api/<kind>')
+@read_replica
+@login_required
+def admin_listing_page(kind):
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    if kind not in ADMIN_ROW_MACROS:
+        return jsonify({'success': False, 'message': 'Unknown listing'}), 404
+    try:
+        rows, next_cursor = admin_listing(kind, request.args.get('cursor'), page_limit())
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    # Rendered rows let the dashboard append a page without duplicating markup
+    row_macro = get_template_attribute('admin/_rows.html', ADMIN_ROW_MACROS[kind])
+    return jsonify({
+        'success': True,
+        'items': [listing_item(kind, row) for row in rows],
+        'html': ''.join(str(row_macro(row)) for row in rows),
+        'next_cursor': next_cursor
+    })
+
+def bikes_due_for_service(until, cursor=None, limit=PAGE_SIZE):
+    # Soonest first, read off the due index
+    query = Bike.query.options(db.load_only(
+        Bike.name, Bike.type, Bike.is_available, Bike.in_maintenance, Bike.kms_since_service,
+        Bike.service_interval, Bike.last_service_date, Bike.service_due_at
+    )).filter(Bike.service_due_at <= until)
+    return keyset_page(query, [Bike.service_due_at, Bike.id], cursor, limit)
+
+@app.route('/admin/api/maintenance-due')
+@read_replica
+@login_required
+def maintenance_due():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    now = datetime.utcnow()
+    try:
+        days = max(0, min(int(request.args.get('days', MAINTENANCE_DUE_SOON_DAYS)), 365))
+        bikes, next_cursor = bikes_due_for_service(now + timedelta(days=days), request.args.get('cursor'),
+                                                   page_limit())
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({
+        'success': True,
+        'items': [{
+            'id': bike.id, 'name': bike.name, 'type': bike.type,
+            'service_due_at': bike.service_due_at.isoformat(), 'overdue': bike.service_due_at <= now,
+            'kms_since_service': bike.kms_since_service, 'service_interval': bike.service_interval,
+            'last_service_date': bike.last_service_date.isoformat() if bike.last_service_date else None,
+            'is_available': bike.is_available, 'in_maintenance': bike.in_maintenance
+        } for bike in bikes],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/admin/service-bike/<int:id>', methods=['POST'])
+@login_required
+def service_bike(id):
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Access denied'})
+    
+    try:
+        bike = Bike.query.get_or_404(id)
+        service = request.form.get('service')
+        if not service:
+            return jsonify({'success': False, 'message': 'Service is required'})
+        date = request.form.get('date')
+        date = datetime.strptime(date, '%Y-%m-%d').date() if date else datetime.utcnow().date()
+        kms = int(request.form['kms']) if request.form.get('kms') else None
+        
+        record_bike_service(bike, date, service, kms)
+        db.session.commit()
+        
+        return jsonify({'success': True, 'next_service_date': bike.next_service_date.isoformat(),
+                        'is_available': bike.is_available})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
 @app.route('/admin/add-bike', methods=['POST'])
 @login_required
 def add_bike():
@@ -650,25 +3954,31 @@ def add_bike():
         price = float(request.form.get('price'))
         min_kms = int(request.form.get('min_kms'))
         image = request.files.get('image')
+        latitude, longitude = None, None
+        if request.form.get('latitude') and request.form.get('longitude'):
+            latitude, longitude = parse_point(request.form)
         
         if not all([name, type, price, min_kms, image]):
             return jsonify({'success': False, 'message': 'All fields are required'})
         
-        # Save image
-        filename = secure_filename(image.filename)
-        image_path = os.path.join('static', 'images', 'bikes', filename)
-        image.save(os.path.join(app.root_path, image_path))
+        # Save the original; the resized variants are built in the background
+        image_path = save_bike_upload(image)
         
         # Create new bike
         bike = Bike(
             name=name,
+            description=request.form.get('description', ''),
             type=type,
             price=price,
             min_kms=min_kms,
             image=image_path,
-            is_available=True
+            is_available=True,
+            latitude=latitude,
+            longitude=longitude
         )
         db.session.add(bike)
+        db.session.flush()
+        queue_bike_image(bike.id, image_path)
         db.session.commit()
         
         return jsonify({'success': True})
@@ -683,15 +3993,11 @@ def delete_bike(id):
     
     try:
         bike = Bike.query.get_or_404(id)
-        
-        # Delete image file
-        if bike.image:
-            try:
-                os.remove(os.path.join(app.root_path, bike.image))
-            except:
-                pass
+        files = image_files(bike.image, bike.image_variants)
         
         db.session.delete(bike)
+        # The original and every resized copy are deleted in the background
+        enqueue_job('remove_bike_images', {'paths': sorted(files)})
         db.session.commit()
         
         return jsonify({'success': True})
@@ -707,16 +4013,17 @@ def admin_cancel_booking(id):
     try:
         ride = Ride.query.get_or_404(id)
         
-        # Get cancellation fee from settings
-        cancellation_fee = float(Settings.get_value('cancellation_fee', '20'))
-        refund_amount = ride.total_price * (1 - cancellation_fee/100)
-        
         # Update ride status
         ride.status = 'cancelled'
-        ride.refund_amount = refund_amount
         
-        # Make bike available
-        ride.bike.is_available = True
+        # The refund and its receipt are worked out in the background, at
+        # the cancellation fee in force now
+        cancellation_fee = float(Settings.get_value('cancellation_fee', '20'))
+        enqueue_job('refund', {'ride_id': ride.id, 'cancellation_fee': cancellation_fee}, key=f'refund:{ride.id}')
+        
+        # Make bike available, unless it is waiting for a service
+        if not ride.bike.in_maintenance:
+            ride.bike.is_available = True
         
         db.session.commit()
         
@@ -733,7 +4040,11 @@ def delete_user(id):
     try:
         user = User.query.get_or_404(id)
         
-        # Delete user's rides
+        # Delete user's rides. The bulk delete skips the session hooks, so
+        # take their pending rides off the drivers' feeds here.
+        pending_ids = [ride_id for ride_id, in db.session.query(Ride.id).filter_by(user_id=id, status='pending')]
+        record_dispatch_events(db.session.connection(), [(ride_id, 'claimed') for ride_id in pending_ids])
+        subtract_ride_metrics(db.session.connection(), Ride.user_id == id)
         Ride.query.filter_by(user_id=id).delete()
         
         # Delete user's loyalty data
@@ -771,90 +4082,197 @@ def update_settings():
     
     return redirect(url_for('admin_dashboard'))
 
+# Exports read this many rows per query
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+def iter_in_batches(query, id_column, batch_size=EXPORT_BATCH_SIZE):
+    # Keyset pagination on the primary key, so every batch costs the same
+    # regardless of how deep into the table the export is
+    last_id = 0
+    while True:
+        batch = query.filter(id_column > last_id).order_by(id_column).limit(batch_size).all()
+        if not batch:
+            return
+        yield from batch
+        last_id = batch[-1].id
+
+def stream_csv(header, rows, flush_every=500):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % flush_every == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
 @app.route('/admin/export-<type>')
+@read_replica
 @login_required
 def export_report(type):
     if not current_user.is_admin:
         flash('Access denied', 'danger')
         return redirect(url_for('admin_dashboard'))
     
+    # Optional filters: ?start=YYYY-MM-DD&end=YYYY-MM-DD&status=<ride status>
     try:
-        if type == 'bookings':
-            rides = Ride.query.all()
-            data = [{
-                'ID': ride.id,
-                'User': ride.user.name,
-                'Bike': ride.bike.name,
-                'Pickup Date': ride.pickup_date.strftime('%d %b %Y'),
-                'Distance': f"{ride.estimated_kms} km",
-                'Total Price': f"₹{ride.total_price}",
-                'Status': ride.status.title()
-            } for ride in rides]
-            filename = 'bookings.csv'
-        
-        elif type == 'users':
-            users = User.query.all()
-            data = [{
-                'Name': user.name,
-                'Email': user.email,
-                'Phone': user.phone,
-                'License': user.license_number,
-                'Loyalty Tier': user.loyalty.tier.name if user.loyalty else 'Not Enrolled',
-                'Status': 'Active' if user.is_active else 'Inactive'
-            } for user in users]
-            filename = 'users.csv'
-        
-        elif type == 'revenue':
-            rides = Ride.query.filter_by(status='completed').all()
-            data = [{
-                'ID': ride.id,
-                'Date': ride.pickup_date.strftime('%d %b %Y'),
-                'User': ride.user.name,
-                'Bike': ride.bike.name,
-                'Distance': f"{ride.estimated_kms} km",
-                'Amount': f"₹{ride.total_price}"
-            } for ride in rides]
-            filename = 'revenue.csv'
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d') if request.args.get('start') else None
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1) if request.args.get('end') else None
+    except ValueError:
+        flash('Invalid date range, expected YYYY-MM-DD', 'danger')
+        return redirect(url_for('admin_dashboard'))
+    status = request.args.get('status')
+    
+    if type in ('bookings', 'revenue'):
+        query = Ride.query.options(
+            db.joinedload(Ride.user).load_only(User.username),
+            db.joinedload(Ride.bike).load_only(Bike.name)
+        )
+        if type == 'revenue':
+            status = 'completed'
+        if status:
+            query = query.filter(Ride.status == status)
+        if start:
+            query = query.filter(Ride.pickup_date >= start)
+        if end:
+            query = query.filter(Ride.pickup_date < end)
+        rides = iter_in_batches(query, Ride.id)
         
+        if type == 'bookings':
+            header = ['ID', 'User', 'Bike', 'Pickup Date', 'Distance', 'Total Price', 'Status']
+            rows = ([
+                ride.id,
+                ride.user.username,
+                ride.bike.name,
+                ride.pickup_date.strftime('%d %b %Y'),
+                f"{ride.estimated_kms} km",
+                f"₹{ride.total_price}",
+                (ride.status or '').title()
+            ] for ride in rides)
         else:
-            flash('Invalid report type', 'danger')
-            return redirect(url_for('admin_dashboard'))
-        
-        # Create CSV file
-        output = StringIO()
-        writer = csv.DictWriter(output, fieldnames=data[0].keys())
-        writer.writeheader()
-        writer.writerows(data)
-        
-        # Return CSV file
-        output.seek(0)
-        return Response(
-            output,
-            mimetype="text/csv",
-            headers={"Content-disposition": f"attachment; filename={filename}"}
+            header = ['ID', 'Date', 'User', 'Bike', 'Distance', 'Amount']
+            rows = ([
+                ride.id,
+                ride.pickup_date.strftime('%d %b %Y'),
+                ride.user.username,
+                ride.bike.name,
+                f"{ride.estimated_kms} km",
+                f"₹{ride.total_price}"
+            ] for ride in rides)
+        filename = f'{type}.csv'
+    
+    elif type == 'users':
+        query = User.query.options(
+            db.joinedload(User.loyalty).joinedload(UserLoyalty.tier)
         )
+        if start:
+            query = query.filter(User.created_at >= start)
+        if end:
+            query = query.filter(User.created_at < end)
+        header = ['Name', 'Email', 'Phone', 'Loyalty Tier', 'Status']
+        rows = ([
+            user.username,
+            user.email,
+            user.phone,
+            user.loyalty.tier.name if user.loyalty and user.loyalty.tier else 'Not Enrolled',
+            'Active' if user.is_active else 'Inactive'
+        ] for user in iter_in_batches(query, User.id))
+        filename = 'users.csv'
     
-    except Exception as e:
-        flash(f'Error generating report: {str(e)}', 'danger')
+    else:
+        flash('Invalid report type', 'danger')
         return redirect(url_for('admin_dashboard'))
+    
+    # Rows are produced while the response is being sent
+    return Response(
+        stream_with_context(stream_csv(header, rows)),
+        mimetype="text/csv",
+        headers={"Content-disposition": f"attachment; filename={filename}"}
+    )
+
+@app.route('/admin/cache-stats')
+@login_required
+def cache_stats():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    return jsonify({
+        'success': True,
+        'user_cache': user_cache.stats()
+    })
+
+# Health probes
+READINESS_CACHE_SECONDS = float(os.getenv('READINESS_CACHE_SECONDS', '5'))
+READINESS_TIMEOUT = float(os.getenv('READINESS_TIMEOUT', '2'))
+
+class ReadinessProbe:
+    # SELECT 1 over a separate one-connection pool, so probes never take a
+    # connection from user requests and a stalled database cannot pile up
+    # probe connections. Each worker runs it at most once per interval;
+    # probes arriving while it runs get the previous result.
+    def __init__(self, interval, timeout):
+        self.interval = interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.engine = None
+        self.result = None
+        self.checked_at = 0.0
+
+    def create_engine(self):
+        url = db.engine.url
+        if url.get_backend_name() == 'postgresql':
+            connect_args = {'connect_timeout': max(int(self.timeout), 1),
+                            'options': f'-c statement_timeout={int(self.timeout * 1000)}'}
+        else:
+            connect_args = {'timeout': self.timeout}
+        return create_engine(url, pool_size=1, max_overflow=0, pool_timeout=self.timeout,
+                             pool_recycle=1800, connect_args=connect_args)
+
+    def check(self):
+        if self.result is not None and time.monotonic() - self.checked_at < self.interval:
+            return self.result
+        # Only the first probe of a worker waits for one already running
+        if not self.lock.acquire(blocking=self.result is None):
+            return self.result
+        try:
+            if self.result is not None and time.monotonic() - self.checked_at < self.interval:
+                return self.result
+            started = time.perf_counter()
+            try:
+                if self.engine is None:
+                    self.engine = self.create_engine()
+                with self.engine.connect() as connection:
+                    connection.exec_driver_sql('SELECT 1')
+                result = {'database': 'connected'}
+            except Exception as e:
+                logger.error(f"Health check failed: {str(e)}")
+                result = {'database': 'unavailable', 'error': str(e)}
+            result['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            result['checked_at'] = datetime.utcnow().isoformat()
+            self.result, self.checked_at = result, time.monotonic()
+            return result
+        finally:
+            self.lock.release()
+
+readiness_probe = ReadinessProbe(READINESS_CACHE_SECONDS, READINESS_TIMEOUT)
+
+@app.route('/health/live')
+def liveness_check():
+    # The process is serving requests; deliberately does not touch the database
+    return jsonify({'status': 'alive', 'timestamp': datetime.utcnow().isoformat()}), 200
 
 @app.route('/health')
+@app.route('/health/ready')
 def health_check():
-    try:
-        # Test database connection
-        db.engine.connect()
-        return jsonify({
-            'status': 'healthy',
-            'database': 'connected',
-            'timestamp': datetime.utcnow().isoformat()
-        }), 200
-    except Exception as e:
-        logger.error(f"Health check failed: {str(e)}")
-        return jsonify({
-            'status': 'unhealthy',
-            'error': str(e),
-            'timestamp': datetime.utcnow().isoformat()
-        }), 500
+    result = readiness_probe.check()
+    healthy = result['database'] == 'connected'
+    return jsonify({
+        'status': 'healthy' if healthy else 'unhealthy',
+        **result,
+        'pool': pool_stats(),
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200 if healthy else 503
 
 @app.errorhandler(Exception)
 def handle_exception(e):
@@ -869,17 +4287,652 @@ def handle_exception(e):
         'traceback': traceback.format_exc() if app.debug else None
     }), 500
 
+# Request instrumentation
+# Expanded IN lists, e.g. "IN (?, ?, ?)" or "IN (%(id_1_1)s, %(id_1_2)s)"
+QUERY_PARAMETER_LIST = re.compile(r'\((?:\?|%s|%\(\w+\)s)(?:, ?(?:\?|%s|%\(\w+\)s))*\)')
+
+class QueryProfile:
+    # The statements one request ran. Statements are grouped by shape, the
+    # SQL text with parameter lists collapsed, so the same lazy load for
+    # different rows counts as one shape repeated.
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = {}
+        self.slowest = []  # min-heap of (seconds, statement)
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        shape = QUERY_PARAMETER_LIST.sub('(...)', statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        if len(self.slowest) < QUERY_PROFILE_SLOWEST:
+            heapq.heappush(self.slowest, (seconds, statement))
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, statement))
+
+    def suspected_n_plus_one(self):
+        # (count, shape) for shapes repeated N_PLUS_ONE_THRESHOLD times or more
+        return sorted(((count, shape) for shape, count in self.shapes.items()
+                       if count >= N_PLUS_ONE_THRESHOLD), reverse=True)
+
+    def slowest_statements(self):
+        return [{'ms': round(seconds * 1000, 2), 'statement': statement[:LOGGED_STATEMENT_LENGTH]}
+                for seconds, statement in sorted(self.slowest, reverse=True)]
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _profile_request_query(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context() and 'queries' in g:
+        g.queries.record(statement, time.perf_counter() - context.query_started)
+
+def pool_stats():
+    # Connection counts of this worker's pool; pools without a fixed size
+    # (SQLite memory databases, NullPool) report what they can
+    pool = db.engine.pool
+    stats = {'class': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        if method is not None:
+            stats[name] = method()
+    if 'overflow' in stats:
+        # QueuePool counts up from -pool_size until overflow connections open
+        stats['overflow'] = max(stats['overflow'], 0)
+    if isinstance(pool, MeasuredQueuePool):
+        stats.update(waits=pool.waits, wait_seconds=round(pool.wait_seconds, 3),
+                     wait_timeouts=pool.wait_timeouts)
+    return stats
+
+# Prometheus metrics. Each process keeps its own samples; under gunicorn set
+# PROMETHEUS_MULTIPROC_DIR so workers write them there and /metrics reports
+# the sum over all workers (gunicorn.conf.py cleans up after dead workers).
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+if prometheus_client is not None:
+    request_latency = prometheus_client.Histogram(
+        'ridewave_request_duration_seconds', 'Request latency by route', ['method', 'route', 'status'])
+    request_queries = prometheus_client.Histogram(
+        'ridewave_request_queries', 'SQL statements per request', ['route'], buckets=QUERY_COUNT_BUCKETS)
+    request_db_time = prometheus_client.Histogram(
+        'ridewave_request_db_seconds', 'Time spent in SQL per request', ['route'])
+    n_plus_one_requests = prometheus_client.Counter(
+        'ridewave_n_plus_one_requests', 'Requests that repeated one statement shape N_PLUS_ONE_THRESHOLD times or more',
+        ['route'])
+    pool_connections = prometheus_client.Gauge(
+        'ridewave_db_pool_connections', 'Database pool connections by state', ['state'], multiprocess_mode='livesum')
+    pool_waits = prometheus_client.Gauge(
+        'ridewave_db_pool_waits', 'Checkouts since worker start that waited for a connection, by outcome',
+        ['outcome'], multiprocess_mode='livesum')
+    pool_wait_time = prometheus_client.Gauge(
+        'ridewave_db_pool_wait_seconds', 'Time spent waiting for a connection since worker start',
+        multiprocess_mode='livesum')
+
+def record_request_metrics(route, status, seconds, profile, suspected):
+    if prometheus_client is None:
+        return
+    route = route or 'unmatched'
+    request_latency.labels(request.method, route, str(status)).observe(seconds)
+    request_queries.labels(route).observe(profile.count)
+    request_db_time.labels(route).observe(profile.seconds)
+    if suspected:
+        n_plus_one_requests.labels(route).inc()
+
+def record_pool_metrics():
+    stats = pool_stats()
+    for state in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if state in stats:
+            pool_connections.labels(state).set(stats[state])
+    if 'waits' in stats:
+        pool_waits.labels('connected').set(stats['waits'] - stats['wait_timeouts'])
+        pool_waits.labels('timed_out').set(stats['wait_timeouts'])
+        pool_wait_time.set(stats['wait_seconds'])
+
+@app.route('/metrics')
+def metrics():
+    if prometheus_client is None:
+        return jsonify({'success': False, 'message': 'prometheus_client is not installed'}), 503
+    token = os.getenv('METRICS_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    record_pool_metrics()
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+def redact(data):
+    if isinstance(data, dict):
+        return {key: '[REDACTED]' if key.lower() in REDACTED_FIELDS else redact(value)
+                for key, value in data.items()}
+    if isinstance(data, list):
+        return [redact(item) for item in data]
+    return data
+
+def request_body_for_log():
+    data = request.get_json(silent=True) if request.is_json else None
+    if data is not None:
+        return redact(data)
+    if request.form:
+        return redact(request.form.to_dict())
+    if request.content_length:
+        # Free-form or malformed bodies cannot be scrubbed by key, so only describe them
+        return {'content_type': request.content_type, 'bytes': request.content_length}
+    return None
+
 @app.before_request
 def before_request():
-    logger.info(f"Request: {request.method} {request.url}")
-    logger.info(f"Headers: {dict(request.headers)}")
-    logger.info(f"Data: {request.get_data()}")
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+    g.queries = QueryProfile()
 
 @app.after_request
 def after_request(response):
-    logger.info(f"Response: {response.status}")
+    response.headers['X-Request-ID'] = g.request_id
+    if DATABASE_REPLICA_URL and g.get('wrote_to_primary'):
+        session['primary_until'] = time.time() + REPLICA_STICKY_SECONDS
+    duration_ms = (time.perf_counter() - g.request_started) * 1000
+    route = request.url_rule.rule if request.url_rule else None
+    profile = g.queries
+    suspected = profile.suspected_n_plus_one()
+    record_request_metrics(route, response.status_code, duration_ms / 1000, profile, suspected)
+    if suspected:
+        count, shape = suspected[0]
+        logger.warning(f"Suspected N+1 in {request.method} {route}: {count} x {shape[:LOGGED_STATEMENT_LENGTH]}")
+    
+    # Errors, slow requests and suspected N+1 patterns are always logged, the rest is sampled
+    detailed = response.status_code >= 500 or duration_ms >= REQUEST_LOG_SLOW_MS or suspected
+    if not detailed and random.random() >= REQUEST_LOG_SAMPLE_RATE:
+        return response
+    
+    fields = {
+        'ts': datetime.utcnow().isoformat(),
+        'request_id': g.request_id,
+        'method': request.method,
+        'route': route,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(duration_ms, 2),
+        'queries': profile.count,
+        'db_ms': round(profile.seconds * 1000, 2),
+        # Touching the session adds Vary: Cookie, which shared caches must not see on static files
+        'user_id': session.get('_user_id') if request.endpoint != 'static' else None
+    }
+    if detailed:
+        fields['slowest_queries'] = profile.slowest_statements()
+    if suspected:
+        fields['n_plus_one'] = [{'count': count, 'statement': shape[:LOGGED_STATEMENT_LENGTH]}
+                                for count, shape in suspected]
+    if REQUEST_LOG_BODIES and request.method in ('POST', 'PUT', 'PATCH'):
+        fields['body'] = request_body_for_log()
+    request_logger.info('request', extra={'fields': fields})
     return response
 
+# Performance suite
+BENCH_PREFIX = 'bench'
+BENCH_PASSWORD = 'bench-password'
+BENCH_RIDE_STATUSES = (['completed', 'pending', 'accepted', 'cancelled'], [0.6, 0.15, 0.15, 0.1])
+
+def insert_in_batches(table, rows, batch_size):
+    # Core executemany in chunks: no ORM objects and no session hooks
+    for start in range(0, len(rows), batch_size):
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), rows[start:start + batch_size])
+    return len(rows)
+
+def seed_synthetic_data(bikes, users, rides, seed=42, batch_size=20000):
+    # Benchmark fixtures, all named with BENCH_PREFIX. Rides are written
+    # straight to the table, so dashboard rollups, loyalty and the service
+    # schedule are rebuilt with the backfill jobs afterwards.
+    if User.query.filter_by(username=f'{BENCH_PREFIX}-admin').first() is not None:
+        raise click.ClickException('Benchmark data already exists; seed a fresh DATABASE_URL')
+    rng = np.random.default_rng(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    password_hash = generate_password_hash(BENCH_PASSWORD, password_hasher.method)
+    counts = {}
+    
+    bike_types = np.array(['Sport', 'Cruiser', 'Touring', 'Electric', 'Naked'])
+    prices = rng.integers(5, 200, bikes) * 100
+    kinds = bike_types[rng.integers(len(bike_types), size=bikes)]
+    latitudes = rng.uniform(12.8, 13.2, bikes)
+    longitudes = rng.uniform(77.4, 77.8, bikes)
+    serviced = rng.integers(0, MAINTENANCE_SERVICE_DAYS * 86400, bikes)
+    # Specs, features and service intervals are borrowed from the sample
+    # bikes; service dates are recent so the fleet is not all overdue
+    details = sorted(set(sample_bikes[0]) - {'name', 'price', 'image', 'type', 'maintenance_history',
+                                             'last_service_date', 'next_service_date'})
+    counts['bikes'] = insert_in_batches(Bike.__table__, [{
+        **{field: sample_bikes[i % len(sample_bikes)].get(field) for field in details},
+        'name': f'{BENCH_PREFIX} bike {i}', 'price': float(price), 'image': 'images/hero-bike.jpg',
+        'type': str(kind), 'is_available': bool(i % 20), 'latitude': float(latitude), 'longitude': float(longitude),
+        'last_service_date': now - timedelta(seconds=int(ago)),
+        'next_service_date': now - timedelta(seconds=int(ago)) + timedelta(days=MAINTENANCE_SERVICE_DAYS)
+    } for i, (price, kind, latitude, longitude, ago) in enumerate(
+        zip(prices, kinds, latitudes, longitudes, serviced))], batch_size)
+    
+    created = now - timedelta(days=365)
+    counts['users'] = insert_in_batches(User.__table__, [{
+        'username': f'{BENCH_PREFIX}-admin', 'email': f'{BENCH_PREFIX}-admin@example.invalid',
+        'password_hash': password_hash, 'is_admin': True, 'is_driver': False, 'created_at': created
+    }] + [{
+        'username': f'{BENCH_PREFIX}-{i}', 'email': f'{BENCH_PREFIX}-{i}@example.invalid',
+        'password_hash': password_hash, 'is_admin': False, 'is_driver': i % 20 == 0,
+        'created_at': created + timedelta(seconds=int(offset))
+    } for i, offset in enumerate(rng.integers(0, 365 * 86400, users))], batch_size)
+    
+    bike_ids = np.array([bike_id for bike_id, in db.session.query(Bike.id).filter(
+        Bike.name.like(f'{BENCH_PREFIX} bike %'))])
+    user_ids = np.array([user_id for user_id, in db.session.query(User.id).filter(
+        User.username.like(f'{BENCH_PREFIX}-%'), User.is_admin.isnot(True))])
+    db.session.commit()
+    statuses, weights = BENCH_RIDE_STATUSES
+    for start in range(0, rides, batch_size):
+        size = min(batch_size, rides - start)
+        pickups = rng.integers(-365 * 86400, 30 * 86400, size)
+        days = rng.integers(1, 8, size)
+        kms = rng.integers(100, 2000, size)
+        ride_bikes = rng.integers(len(bike_ids), size=size)
+        ride_users = rng.integers(len(user_ids), size=size)
+        ride_statuses = rng.choice(len(statuses), size=size, p=weights)
+        rows = []
+        for pickup, duration, distance, bike, user, status in zip(
+                pickups.tolist(), days.tolist(), kms.tolist(), ride_bikes.tolist(),
+                ride_users.tolist(), ride_statuses.tolist()):
+            pickup_date = now + timedelta(seconds=pickup)
+            rows.append({
+                'pickup_location': 'Synthetic pickup', 'dropoff_location': 'Synthetic dropoff',
+                'date': pickup_date, 'status': statuses[status], 'user_id': int(user_ids[user]),
+                'bike_id': int(bike_ids[bike]), 'pickup_date': pickup_date,
+                'dropoff_date': pickup_date + timedelta(days=duration), 'estimated_kms': distance,
+                'total_price': float(distance * 10), 'security_deposit': 5000.0, 'insurance_type': 'basic',
+                'license_number': 'BENCH', 'riding_experience': 1
+            })
+        insert_in_batches(Ride.__table__, rows, batch_size)
+    counts['rides'] = rides
+    
+    with db.engine.begin() as connection:
+        rebuild_search_index(connection)
+        rebuild_service_schedule(connection)
+    backfill_daily_metrics()
+    recompute_loyalty(restart=True)
+    # Fresh planner statistics, as a long-running database would have
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('ANALYZE')
+    CacheVersion.bump('catalog')
+    CacheVersion.bump('users')
+    db.session.commit()
+    return counts
+
+@app.cli.command('seed-data')
+@click.option('--bikes', default=10000, help='Bikes to create')
+@click.option('--users', default=200000, help='Users to create')
+@click.option('--rides', default=1000000, help='Rides to create')
+@click.option('--seed', default=42, help='Random seed, for reproducible datasets')
+@click.option('--batch-size', default=20000, help='Rows per insert transaction')
+def seed_data_command(bikes, users, rides, seed, batch_size):
+    """Fill the database with synthetic bikes, users and rides for benchmarks."""
+    started = time.perf_counter()
+    counts = seed_synthetic_data(bikes, users, rides, seed, batch_size)
+    counts['seconds'] = round(time.perf_counter() - started, 1)
+    click.echo(json.dumps(counts, indent=2))
+
+class LoadClient:
+    # One virtual user. In-process it drives the app through the test client
+    # and reads each request's query count; with a base URL it speaks HTTP
+    # to a running server and queries are not known.
+    def __init__(self, base_url=None):
+        self.base_url = base_url
+        if base_url:
+            self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+        else:
+            self.client = app.test_client()
+
+    def login(self, user_id, username):
+        if self.base_url:
+            self.request('POST', '/login', form={'username': username, 'password': BENCH_PASSWORD})
+        else:
+            with self.client.session_transaction() as client_session:
+                client_session['_user_id'] = str(user_id)
+                client_session['_fresh'] = True
+
+    def request(self, method, path, json_body=None, form=None):
+        # Returns (status, queries or None)
+        if not self.base_url:
+            load_test_queries.count = None
+            response = self.client.open(path, method=method, json=json_body, data=form)
+            response.close()
+            return response.status_code, load_test_queries.count
+        data, headers = None, {}
+        if json_body is not None:
+            data, headers = json.dumps(json_body).encode('utf-8'), {'Content-Type': 'application/json'}
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode('utf-8')
+        http_request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(http_request, timeout=60) as response:
+                response.read()
+                return response.status, None
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+load_test_queries = threading.local()
+
+# Streamed responses (the CSV export) run their queries after this fires,
+# so they report only the queries made before streaming started
+@request_finished.connect_via(app)
+def _record_load_test_queries(sender, response, **extra):
+    profile = g.get('queries')
+    load_test_queries.count = profile.count if profile is not None else None
+
+def load_test_scenarios(bike_ids, export_days):
+    # name -> (weight, role, build) where build(rng) returns (method, path, json body)
+    today = datetime.utcnow().date()
+    def booking(rng):
+        start = today + timedelta(days=int(rng.integers(30, 3000)))
+        return 'POST', '/book-ride', {
+            'bike_id': int(rng.choice(bike_ids)), 'start_date': start.isoformat(),
+            'end_date': (start + timedelta(days=int(rng.integers(1, 5)))).isoformat(), 'insurance': 'basic'
+        }
+    export_start = (today - timedelta(days=export_days)).isoformat()
+    return {
+        'index': (20, None, lambda rng: ('GET', '/', None)),
+        'bikes': (10, None, lambda rng: ('GET', '/bikes', None)),
+        'bike_detail': (20, None, lambda rng: ('GET', f'/bike/{int(rng.choice(bike_ids))}', None)),
+        'book_ride': (10, 'user', booking),
+        'my_rides': (20, 'user', lambda rng: ('GET', '/my-rides', None)),
+        'admin': (5, 'admin', lambda rng: ('GET', '/admin', None)),
+        'export_bookings': (1, 'admin', lambda rng: (
+            'GET', f'/admin/export-bookings?start={export_start}&end={today.isoformat()}', None)),
+    }
+
+def latency_summary(durations, queries, errors, elapsed):
+    durations = np.array(durations) * 1000
+    summary = {
+        'requests': int(len(durations)),
+        'errors': errors,
+        'throughput_rps': round(len(durations) / elapsed, 1) if elapsed else 0.0,
+    }
+    if len(durations):
+        summary.update({
+            'mean_ms': round(float(durations.mean()), 2),
+            'p50_ms': round(float(np.percentile(durations, 50)), 2),
+            'p95_ms': round(float(np.percentile(durations, 95)), 2),
+            'p99_ms': round(float(np.percentile(durations, 99)), 2),
+        })
+    known = [count for count in queries if count is not None]
+    summary['queries_per_request'] = round(sum(known) / len(known), 2) if known else None
+    return summary
+
+def run_load_test(duration=30, concurrency=8, base_url=None, routes=None, warmup=2, seed=42, export_days=7):
+    # Each worker thread is one logged-in user (plus an admin session) that
+    # picks routes by weight until the time runs out. Results from the
+    # warm-up period are dropped.
+    users = db.session.query(User.id, User.username).filter(
+        User.username.like(f'{BENCH_PREFIX}-%'), User.is_admin.isnot(True)
+    ).order_by(User.id).limit(max(concurrency * 10, 100)).all()
+    admin = db.session.query(User.id, User.username).filter_by(username=f'{BENCH_PREFIX}-admin').first()
+    bike_ids = [bike_id for bike_id, in db.session.query(Bike.id).filter(
+        Bike.name.like(f'{BENCH_PREFIX} bike %'), Bike.is_available == True).limit(5000)]
+    db.session.remove()
+    if not users or admin is None or not bike_ids:
+        raise click.ClickException('No benchmark data found; run flask seed-data first')
+    
+    scenarios = load_test_scenarios(bike_ids, export_days)
+    if routes:
+        unknown = set(routes) - set(scenarios)
+        if unknown:
+            raise click.ClickException(f'Unknown routes: {", ".join(sorted(unknown))}')
+        scenarios = {name: scenario for name, scenario in scenarios.items() if name in routes}
+    names = list(scenarios)
+    weights = np.array([scenarios[name][0] for name in names], dtype=float)
+    weights /= weights.sum()
+    
+    results = {name: {'durations': [], 'queries': [], 'errors': 0} for name in names}
+    results_lock = threading.Lock()
+    started = time.perf_counter()
+    measure_from = started + warmup
+    deadline = measure_from + duration
+    
+    def worker(index):
+        rng = np.random.default_rng(seed + index)
+        user_id, username = users[index % len(users)]
+        clients = {None: LoadClient(base_url), 'user': LoadClient(base_url), 'admin': LoadClient(base_url)}
+        # No app context is held here: each request gets its own, as under a
+        # real server, so sessions and g do not leak between requests
+        clients['user'].login(user_id, username)
+        clients['admin'].login(*admin)
+        while True:
+            name = names[rng.choice(len(names), p=weights)]
+            method, path, body = scenarios[name][2](rng)
+            request_started = time.perf_counter()
+            if request_started >= deadline:
+                return
+            try:
+                status, queries = clients[scenarios[name][1]].request(method, path, json_body=body)
+            except Exception:
+                status, queries = 599, None
+            finished = time.perf_counter()
+            if request_started < measure_from:
+                continue
+            with results_lock:
+                results[name]['durations'].append(finished - request_started)
+                results[name]['queries'].append(queries)
+                results[name]['errors'] += status >= 400
+    
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - measure_from
+    
+    report = {
+        'database': db.engine.dialect.name,
+        'target': base_url or 'in-process',
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 1),
+        'routes': {name: latency_summary(result['durations'], result['queries'], result['errors'], elapsed)
+                   for name, result in results.items()},
+    }
+    report['total'] = latency_summary(
+        [d for result in results.values() for d in result['durations']],
+        [q for result in results.values() for q in result['queries']],
+        sum(result['errors'] for result in results.values()), elapsed
+    )
+    return report
+
+def load_test_regressions(report, baseline, tolerance):
+    # Routes whose p95 got slower than the baseline by more than `tolerance`
+    regressions = {}
+    for name, current in report['routes'].items():
+        previous = baseline.get('routes', {}).get(name)
+        if previous and previous.get('p95_ms') and current.get('p95_ms'):
+            change = current['p95_ms'] / previous['p95_ms'] - 1
+            if change > tolerance:
+                regressions[name] = {'baseline_p95_ms': previous['p95_ms'], 'p95_ms': current['p95_ms'],
+                                     'change': round(change, 3)}
+    return regressions
+
+@app.cli.command('load-test')
+@click.option('--duration', default=30, help='Measured seconds')
+@click.option('--warmup', default=2, help='Seconds of traffic before measuring starts')
+@click.option('--concurrency', default=8, help='Concurrent virtual users')
+@click.option('--url', default=None, help='Base URL of a running server; default drives the app in-process')
+@click.option('--route', 'routes', multiple=True, help='Only exercise these scenarios (repeatable)')
+@click.option('--export-days', default=7, help='Date range of the export-bookings scenario')
+@click.option('--seed', default=42, help='Random seed for the request mix')
+@click.option('--output', type=click.Path(dir_okay=False), help='Also write the JSON report here')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Earlier report to compare p95 against')
+@click.option('--tolerance', default=0.2, help='Allowed p95 slowdown against the baseline, as a fraction')
+def load_test_command(duration, warmup, concurrency, url, routes, export_days, seed, output, baseline, tolerance):
+    """Drive the main pages with concurrent users and report latency percentiles as JSON."""
+    report = run_load_test(duration, concurrency, url.rstrip('/') if url else None, routes, warmup, seed, export_days)
+    if baseline:
+        with open(baseline) as f:
+            report['regressions'] = load_test_regressions(report, json.load(f), tolerance)
+    text = json.dumps(report, indent=2)
+    click.echo(text)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    if report.get('regressions'):
+        sys.exit(1)
+
+# Schema management
+def upgrade_schema():
+    # Bring an existing database up to the models without dropping data:
+    # create missing tables, add missing columns, widen string columns and
+    # create missing indexes. Safe to run repeatedly.
+    engine = db.engine
+    db.create_all()
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    changes = []
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name']: column for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                current = existing.get(column.name)
+                column_type = column.type.compile(dialect=engine.dialect)
+                if current is None:
+                    connection.exec_driver_sql(
+                        f'ALTER TABLE {preparer.format_table(table)} '
+                        f'ADD COLUMN {preparer.format_column(column)} {column_type}'
+                    )
+                    changes.append(f'added column {table.name}.{column.name}')
+                elif (engine.dialect.name == 'postgresql' and isinstance(column.type, db.String)
+                        and column.type.length
+                        and (getattr(current['type'], 'length', None) or 0) < column.type.length):
+                    connection.exec_driver_sql(
+                        f'ALTER TABLE {preparer.format_table(table)} '
+                        f'ALTER COLUMN {preparer.format_column(column)} TYPE {column_type}'
+                    )
+                    changes.append(f'widened column {table.name}.{column.name}')
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    changes.append(f'created index {index.name}')
+        if ensure_search_index(connection):
+            changes.append('created the bike search index')
+        if 'maintenance_history' in {column['name'] for column in inspector.get_columns('bike')}:
+            moved = migrate_maintenance_history(connection)
+            if moved:
+                changes.append(f'moved {moved} service records to bike_service')
+        scheduled = rebuild_service_schedule(connection, only_missing=True)
+        if scheduled:
+            changes.append(f'scheduled the next service of {scheduled} bikes')
+    # Slots are the only transactional guard against double bookings, so
+    # bookings made before they existed must claim theirs
+    if BookingSlot.query.first() is None and Booking.query.first() is not None:
+        count = backfill_booking_slots()
+        changes.append(f'claimed reservation slots for {count} bookings')
+    # Databases from before the rollups existed start with an empty table
+    if DailyMetrics.query.first() is None and (Ride.query.first() is not None or User.query.first() is not None):
+        days = backfill_daily_metrics()
+        changes.append(f'backfilled dashboard metrics for {days} days')
+    for change in changes:
+        logger.info(f"Schema upgrade: {change}")
+    return changes
+
+def migrate_maintenance_history(connection):
+    # Move the old bike.maintenance_history JSON lists into bike_service.
+    # The column is emptied as it goes, so later runs find nothing to move.
+    rows = connection.exec_driver_sql(
+        'SELECT id, maintenance_history FROM bike WHERE maintenance_history IS NOT NULL'
+    ).fetchall()
+    services = []
+    for bike_id, history in rows:
+        if isinstance(history, str):
+            history = json.loads(history)
+        services.extend({'bike_id': bike_id, **service_fields(entry)} for entry in history or [])
+    if services:
+        connection.execute(BikeService.__table__.insert(), services)
+    if rows:
+        connection.exec_driver_sql('UPDATE bike SET maintenance_history = NULL WHERE maintenance_history IS NOT NULL')
+    return len(services)
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables, columns and indexes."""
+    changes = upgrade_schema()
+    click.echo('\n'.join(changes) or 'Schema is up to date')
+
+def explain_plan(statement):
+    # Returns (plan lines, tables read with a full scan)
+    connection = db.session.connection()
+    compiled = statement.compile(dialect=connection.dialect)
+    if connection.dialect.name == 'postgresql':
+        # Penalise sequential scans so the planner only picks one when no
+        # index applies, however small the tables are
+        connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        plan = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar()
+        nodes = [plan[0]['Plan']]
+        lines, scans = [], []
+        while nodes:
+            node = nodes.pop()
+            lines.append(f"{node['Node Type']} {node.get('Relation Name', '')}".strip())
+            if node['Node Type'] == 'Seq Scan':
+                scans.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return lines, scans
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params).fetchall()
+    lines = [row[-1] for row in rows]
+    # SCAN walks the whole table (or a whole index); SEARCH uses an index
+    scans = [line.split()[1] for line in lines if line.startswith('SCAN ') and line != 'SCAN CONSTANT ROW']
+    return lines, scans
+
+def hot_queries():
+    now = datetime.utcnow()
+    counts = dashboard_counts(now)
+    # Pages past the first, as the listings run them: seek past the cursor,
+    # in key order, limited
+    ride_key = [Ride.pickup_date, Ride.id]
+    ride_cursor = encode_cursor([now, 1])
+    admin_bookings, admin_key, descending = admin_listing_query('bookings')
+    return [
+        ('my_rides', keyset_query(rides_for_user(1), ride_key, ride_cursor, descending=True).statement),
+        ('driver_rides', keyset_query(pending_rides(), ride_key, ride_cursor).statement),
+        ('admin bookings listing', keyset_query(
+            admin_bookings, admin_key, ride_cursor, descending=descending).statement),
+        # The slot insert conflicts on the primary key; this is the same lookup
+        ('book_ride: slot conflicts', db.select(BookingSlot.booking_id).where(
+            BookingSlot.bike_id == 1, BookingSlot.day.between(now.date(), (now + timedelta(days=3)).date())
+        )),
+        ('cancel booking: slots to free', db.select(BookingSlot.day).where(BookingSlot.booking_id == 1)),
+        ('availability index refresh', AvailabilityIndex.bookings_query().statement),
+        ('bike search: free on dates', db.select(Bike.id).where(*search_conditions(parse_search_args({
+            'start_date': now.strftime('%Y-%m-%d'), 'end_date': (now + timedelta(days=3)).strftime('%Y-%m-%d')
+        }), db.engine.dialect.name))),
+        ('admin_dashboard: active bookings', counts['active_bookings']),
+        ('admin_dashboard: booked bikes', counts['booked_bikes']),
+        ('admin_dashboard: maintenance bikes', counts['maintenance_bikes']),
+        ('admin_dashboard: rollups', DailyMetrics.query.filter(DailyMetrics.day >= now.date()).statement),
+        ('maintenance sweep', db.select(Bike.id).where(Bike.service_due_at <= now, Bike.is_available == True)),
+        ('maintenance due soon', db.select(Bike.id)
+            .where(Bike.service_due_at <= now + timedelta(days=MAINTENANCE_DUE_SOON_DAYS))
+            .order_by(Bike.service_due_at, Bike.id).limit(PAGE_SIZE)),
+    ]
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """EXPLAIN the hot queries and fail if any reads a table with a full scan."""
+    failed = False
+    for name, statement in hot_queries():
+        lines, scans = explain_plan(statement)
+        failed = failed or bool(scans)
+        click.echo(f"{'FAIL' if scans else 'ok'}  {name}")
+        for line in lines:
+            click.echo(f'      {line}')
+    db.session.rollback()
+    if failed:
+        sys.exit(1)
+
 def init_db():
     try:
         with app.app_context():
@@ -887,25 +4940,35 @@ def init_db():
             db.engine.connect()
             logger.info("Database connection successful")
             
-            # Create tables
-            db.create_all()
+            # Create tables and bring older databases up to date
+            upgrade_schema()
             logger.info("Database tables created")
             
             # Initialize sample data
             if Bike.query.count() == 0:
+                # The fixtures' service history is old; their next service is
+                # counted from install time, or the first maintenance sweep
+                # would take the whole catalog offline
+                next_service = datetime.utcnow() + timedelta(days=MAINTENANCE_SERVICE_DAYS)
                 for bike_data in sample_bikes:
-                    bike = Bike(**bike_data)
+                    bike_data = dict(bike_data, next_service_date=next_service)
+                    history = bike_data.pop('maintenance_history', [])
+                    bike = Bike(**bike_data, maintenance_history=[
+                        BikeService(**service_fields(entry)) for entry in history])
                     db.session.add(bike)
                 db.session.commit()
                 logger.info("Sample bikes added to database")
             
+            if LoyaltyTier.query.count() == 0:
+                for tier_data in loyalty_tiers:
+                    db.session.add(LoyaltyTier(**tier_data))
+                db.session.commit()
+                logger.info("Loyalty tiers added to database")
+            
             if Settings.query.count() == 0:
-                settings = Settings(
-                    security_deposit=5000,
-                    points_per_100=10,
-                    cancellation_fee=20
-                )
-                db.session.add(settings)
+                for key, value, description in default_settings:
+                    db.session.add(Settings(key=key, value=value, description=description))
+                CacheVersion.bump('settings')
                 db.session.commit()
                 logger.info("Default settings added to database")
             
@@ -920,6 +4983,10 @@ if __name__ == '__main__':
         # Initialize database
         init_db()
         
+        # The development server runs background jobs itself; deployments
+        # run `flask jobs-worker` as a separate process
+        threading.Thread(target=JobWorker(threads=2).run, name='jobs', daemon=True).start()
+        
         # Start the application
         logger.info("Starting application...")
         app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,21 @@
+# Gunicorn loads this file from the working directory on its own.
+import os
+import shutil
+import tempfile
+
+# Workers write their Prometheus samples here so /metrics can sum them.
+# Set before any worker imports the app, since the client reads it at import.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'ridewave-metrics'))
+
+def on_starting(server):
+    # Samples from a previous run would otherwise be added to this one's
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,36 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app reads its configuration at import, so point it at a throwaway
+# SQLite database before any test imports it
+DATABASE_DIR = tempfile.mkdtemp(prefix='ridewave-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(DATABASE_DIR, 'ridewave.db')}"
+os.environ['MAINTENANCE_SWEEP_SECONDS'] = '0'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope='session')
+def ridewave():
+    import app as ridewave
+    ridewave.init_db()
+    return ridewave
+
+@pytest.fixture
+def app_context(ridewave):
+    with ridewave.app.app_context():
+        yield
+        ridewave.db.session.remove()
+
+@pytest.fixture
+def run_command(ridewave):
+    # Runs a Flask CLI command and returns its exit code and JSON report
+    def run(name, *args):
+        result = ridewave.app.test_cli_runner().invoke(args=[name, *map(str, args)])
+        if result.exception and not isinstance(result.exception, SystemExit):
+            raise result.exception
+        return result.exit_code, json.loads(result.stdout)
+    return run
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+def test_concurrent_bookings_never_overlap(run_command):
+    exit_code, report = run_command('booking-stress', '--threads', 8, '--attempts', 300,
+                                    '--bikes', 2, '--days', 20)
+    assert exit_code == 0
+    assert report['double_bookings'] == 0
+    assert report['booked'] > 0 and report['conflicts'] > 0
+
+def test_slots_reject_overlaps_until_cancelled(ridewave, app_context):
+    db = ridewave.db
+    user, bikes, _ = ridewave.create_stress_fixtures(1)
+    start = datetime.combine(datetime.utcnow().date() + timedelta(days=4000), datetime.min.time())
+    try:
+        booking = ridewave.reserve_bike(user.id, bikes[0].id, start, start + timedelta(days=3), 0)
+        with pytest.raises(ridewave.BikeUnavailable):
+            ridewave.reserve_bike(user.id, bikes[0].id, start + timedelta(days=2), start + timedelta(days=5), 0)
+        # Back to back is not an overlap
+        ridewave.reserve_bike(user.id, bikes[0].id, start + timedelta(days=3), start + timedelta(days=4), 0)
+
+        booking.status = 'cancelled'
+        db.session.commit()
+        ridewave.reserve_bike(user.id, bikes[0].id, start + timedelta(days=1), start + timedelta(days=2), 0)
+    finally:
+        bike_ids = [bike.id for bike in bikes]
+        ridewave.BookingSlot.query.filter(ridewave.BookingSlot.bike_id.in_(bike_ids)).delete()
+        ridewave.Booking.query.filter(ridewave.Booking.bike_id.in_(bike_ids)).delete()
+        ridewave.delete_stress_fixtures(user, bikes)
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+def make_ride(ridewave, user_id, bike_id, **fields):
+    pickup = datetime.utcnow() + timedelta(days=4000)
+    ride = ridewave.Ride(
+        user_id=user_id, bike_id=bike_id, pickup_location='Test', dropoff_location='Test', date=pickup,
+        pickup_date=pickup, dropoff_date=pickup + timedelta(days=1), estimated_kms=0, total_price=0,
+        security_deposit=0, insurance_type='basic', license_number='TEST', riding_experience=0, **fields
+    )
+    ridewave.db.session.add(ride)
+    ridewave.db.session.commit()
+    return ride
+
+def dispatch_events(ridewave, ride_ids):
+    return [(event.ride_id, event.kind) for event in ridewave.DispatchEvent.query.filter(
+        ridewave.DispatchEvent.ride_id.in_(ride_ids)).order_by(ridewave.DispatchEvent.id)]
+
+def test_concurrent_claims_have_one_winner(run_command):
+    exit_code, report = run_command('dispatch-stress', '--drivers', 30, '--rides', 50, '--threads', 8)
+    assert exit_code == 0
+    assert report['double_claims'] == 0 and report['unowned_claims'] == 0
+    assert 0 < report['claimed'] <= 50
+    assert report['claimed'] + report['lost'] + report['errors'] == report['attempts']
+
+def test_claim_ride_is_won_once(ridewave, app_context):
+    user, bikes, drivers = ridewave.create_stress_fixtures(1, 2)
+    ride = make_ride(ridewave, user.id, bikes[0].id, status='pending')
+    try:
+        assert ridewave.claim_ride(ride.id, drivers[0].id)
+        assert not ridewave.claim_ride(ride.id, drivers[1].id)
+        ridewave.db.session.expire_all()
+        assert ridewave.db.session.get(ridewave.Ride, ride.id).driver_id == drivers[0].id
+        assert dispatch_events(ridewave, [ride.id]) == [(ride.id, 'pending'), (ride.id, 'claimed')]
+    finally:
+        ridewave.DispatchEvent.query.filter_by(ride_id=ride.id).delete()
+        ridewave.Ride.query.filter_by(id=ride.id).delete()
+        ridewave.delete_stress_fixtures(user, bikes, drivers)
+
+def test_deleting_a_rider_takes_their_pending_rides_off_the_feed(ridewave):
+    with ridewave.app.app_context():
+        admin = ridewave.User(username='dispatch-admin', email='dispatch-admin@example.invalid',
+                              password_hash='!', is_admin=True)
+        ridewave.db.session.add(admin)
+        ridewave.db.session.commit()
+        rider, bikes, _ = ridewave.create_stress_fixtures(1)
+        pending = make_ride(ridewave, rider.id, bikes[0].id, status='pending')
+        completed = make_ride(ridewave, rider.id, bikes[0].id, status='completed')
+        admin_id, rider_id, bike_id, ride_ids = admin.id, rider.id, bikes[0].id, [pending.id, completed.id]
+
+    client = ridewave.app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['_user_id'] = str(admin_id)
+    assert client.post(f'/admin/delete-user/{rider_id}').get_json() == {'success': True}
+
+    with ridewave.app.app_context():
+        assert dispatch_events(ridewave, ride_ids) == [(ride_ids[0], 'pending'), (ride_ids[0], 'claimed')]
+        ridewave.DispatchEvent.query.filter(ridewave.DispatchEvent.ride_id.in_(ride_ids)).delete()
+        ridewave.delete_stress_fixtures(ridewave.db.session.get(ridewave.User, admin_id),
+                                        [ridewave.db.session.get(ridewave.Bike, bike_id)])
+
+def test_hub_turns_away_streams_past_its_cap(ridewave):
+    hub = ridewave.DispatchHub(max_subscribers=1)
+    first = hub.subscribe()
+    assert first is not None
+    assert hub.subscribe() is None
+    hub.unsubscribe(first)
+    assert hub.subscribe() is not None
@@ -0,0 +1,16 @@
+def test_load_test_serves_every_route_without_errors(run_command):
+    exit_code, counts = run_command('seed-data', '--bikes', 50, '--users', 50, '--rides', 500, '--batch-size', 200)
+    assert exit_code == 0
+    assert counts['rides'] == 500
+
+    exit_code, report = run_command('load-test', '--duration', 3, '--warmup', 1, '--concurrency', 4)
+    assert exit_code == 0
+    assert report['total']['requests'] > 0
+    assert {name: route['errors'] for name, route in report['routes'].items() if route['errors']} == {}
+
+def test_regressions_compare_p95_against_the_baseline(ridewave):
+    baseline = {'routes': {'index': {'p95_ms': 10.0}, 'bikes': {'p95_ms': 20.0}, 'admin': {'p95_ms': 5.0}}}
+    report = {'routes': {'index': {'p95_ms': 13.0}, 'bikes': {'p95_ms': 21.0}, 'my_rides': {'p95_ms': 50.0}}}
+    assert ridewave.load_test_regressions(report, baseline, tolerance=0.2) == {
+        'index': {'baseline_p95_ms': 10.0, 'p95_ms': 13.0, 'change': 0.3}
+    }
@@ -0,0 +1,11 @@
+def test_hot_queries_use_indexes(ridewave, app_context):
+    scans = {name: ridewave.explain_plan(statement)[1] for name, statement in ridewave.hot_queries()}
+    ridewave.db.session.rollback()
+    assert {name: tables for name, tables in scans.items() if tables} == {}
+
+def test_full_scans_are_reported(ridewave, app_context):
+    # Nothing indexes license numbers, so the check has to flag this one
+    _, scans = ridewave.explain_plan(
+        ridewave.db.select(ridewave.Ride.id).where(ridewave.Ride.license_number == 'DL-0000')
+    )
+    assert scans == ['ride']
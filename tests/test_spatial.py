@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+def brute_force(ridewave, points, latitude, longitude, k, radius_km):
+    distances = sorted((ridewave.haversine_km(latitude, longitude, lat, lon), point_id)
+                       for point_id, (lat, lon) in points.items())
+    return [point_id for distance, point_id in distances if distance <= radius_km][:k]
+
+@pytest.mark.parametrize('centre', [(12.97, 77.59), (51.5, -0.12), (89.9, 10.0), (-89.95, -120.0), (0.0, 179.99)],
+                         ids=['bengaluru', 'london', 'north-pole', 'south-pole', 'antimeridian'])
+def test_grid_matches_brute_force(ridewave, centre):
+    rng = random.Random(42)
+    index = ridewave.GridIndex(cell_degrees=0.01, max_radius_km=50)
+    points = {}
+    for point_id in range(2000):
+        # Dense near the centre, sparse further out, wrapped onto the globe
+        spread = 0.05 if point_id % 4 else 0.6
+        latitude = max(-90.0, min(90.0, rng.gauss(centre[0], spread)))
+        longitude = (rng.gauss(centre[1], spread) + 180) % 360 - 180
+        points[point_id] = (latitude, longitude)
+        index.insert(point_id, latitude, longitude)
+    # Moved and removed points must not linger in their old cells
+    for point_id in range(0, 2000, 10):
+        points[point_id] = (points[point_id][0] + 0.3, points[point_id][1])
+        index.insert(point_id, *points[point_id])
+    for point_id in range(5, 2000, 10):
+        del points[point_id]
+        index.remove(point_id)
+
+    for _ in range(50):
+        latitude = max(-90.0, min(90.0, centre[0] + rng.uniform(-0.5, 0.5)))
+        longitude = (centre[1] + rng.uniform(-0.5, 0.5) + 180) % 360 - 180
+        found = [point_id for _, point_id in index.nearest(latitude, longitude, k=5)]
+        assert found == brute_force(ridewave, points, latitude, longitude, 5, 50)
+        within = [point_id for _, point_id in index.within(latitude, longitude, 2.0)]
+        assert within == brute_force(ridewave, points, latitude, longitude, len(points), 2.0)
+
+def test_searches_stop_at_the_maximum_radius(ridewave):
+    index = ridewave.GridIndex(cell_degrees=0.01, max_radius_km=50)
+    index.insert(1, 12.97, 77.59)
+    assert index.nearest(40.0, -74.0, k=1) == []
+    assert index.nearest(40.0, -74.0, k=1, radius_km=20000) == []
+    assert [point_id for _, point_id in index.nearest(13.1, 77.59, k=1)] == [1]
+
+def test_spatial_benchmark_agrees_with_a_full_scan(run_command):
+    exit_code, report = run_command('spatial-benchmark', '--points', 5000, '--queries', 200)
+    assert exit_code == 0
+    assert report['mismatches'] == 0